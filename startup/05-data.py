@@ -12,6 +12,13 @@ def fetch_scan(**kwargs):
         headers = db(**kwargs)
         return headers, db.get_table(headers, fill=True)
 
+def fetch_scan_columns(uid=-1, stream_name="primary", keys=None, fill=False):
+    """ return the header and the events as columns, see EventColumns in 39-original_suitcase.py
+        this is much faster than header.table() for long scans
+    """
+    header = db[uid]
+    return header, EventColumns(header.events(stream_name=stream_name, fill=fill), keys)
+
 def list_scans(**kwargs):
     headers = list(db(**kwargs))
     uids = []
@@ -12,6 +12,7 @@ from ophyd.device import Staged
 from pathlib import Path
 
 import os,time,threading
+import bluesky.preprocessors as bpp
 from types import SimpleNamespace
 
 from enum import Enum
@@ -308,6 +309,10 @@ class LiXDetectors(Device):
     trig_wait = 1.
     acq_time = 1.
     trigger_mode = PilatusTriggerMode.soft
+    # called with the number of bytes expected from the scan before the run starts, see 
+    # ramdisk_capacity_wrapper(), e.g. RamdiskMonitor.check_scan(); this may raise an exception to 
+    # stop the plan, or return a plan (e.g. waiting for space) to run before the run is opened
+    capacity_check = None
 
     
     def __init__(self, prefix):
@@ -394,6 +399,19 @@ class LiXDetectors(Device):
         for det in self.dets.values():
             det.set_thresh(ene)
             
+    def expected_bytes(self, num_points=1):
+        """ the size of the data the active detectors will write during a scan of num_points, 
+            assuming uncompressed 32-bit frames
+            each point takes _num_images frames, in external trigger mode the whole series of 
+            _num_images x _num_repeats frames may be taken within a single point (fly scans)
+        """
+        nframes = self._num_images*max(num_points, self._num_repeats)
+        nb = 0
+        for det in self.active_detectors:
+            shape = PilatusCBFHandler.std_image_size[det.detector_id]
+            nb += 4*shape[0]*shape[1]*nframes
+        return nb
+    
     def stage(self):
         if self._staged == Staged.yes:
             return
@@ -467,6 +485,23 @@ class LiXDetectors(Device):
 #        common_attrs = self.active_detectors[0].describe()
         
                                     
+def ramdisk_capacity_wrapper(plan):
+    """ a RunEngine preprocessor, call pil.capacity_check() with the size of the data expected from 
+        the scan, when the run is opened: the number of points is only known from the metadata 
+        then, the detectors are usually staged already, but have not been triggered yet
+        if the check returns a plan, it runs before the run is opened, so that the RunEngine can 
+        still be paused or aborted while it waits
+        e.g. RE.preprocessors.append(ramdisk_capacity_wrapper)
+    """
+    def check(msg):
+        if msg.command=='open_run' and LiXDetectors.capacity_check is not None and 'pil' in globals():
+            if pil._staged==Staged.yes or pil.name in msg.kwargs.get('detectors', []):
+                hold = pil.capacity_check(pil.expected_bytes(msg.kwargs.get('num_points', 1)))
+                if hold is not None:
+                    return bpp.pchain(hold, bpp.single_gen(msg)),None
+        return None,None
+    return (yield from bpp.plan_mutator(plan, check))
+
 try:
     pil = LiXDetectors("XF:16IDC-DT")   
     pil.activate(["pil1M", "pilW2"])
@@ -0,0 +1,430 @@
+import os,sys,mmap,time,collections,threading,hashlib,select,struct,ctypes,ctypes.util
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# reads the Pilatus CBF files (byte-offset compression) directly, see PilatusCBFHandler.get_data()
+# fabio parses the entire header in python, and allocates several intermediate arrays per frame
+
+cbf_binary_marker = b"\x0c\x1a\x04\xd5"
+
+def _cbf_header_value(buf, key, start, end):
+    """ the value for key (e.g. b"X-Binary-Size:") in the MIME header of the binary section
+    """
+    i = buf.find(key, start, end)
+    if i<0:
+        raise Exception(f"{key.decode()} not found in the CBF header")
+    i += len(key)
+    return buf[i:buf.find(b"\r\n", i, end)].strip()
+
+def _byte_offset_deltas(b):
+    """ the differences between consecutive pixels, from the byte-offset stream b (int8)
+        a delta is a single byte, unless the byte is -128, then the delta is the int16 that
+        follows, unless that is -32768, then the delta is the int32 that follows
+        the escapes are located with numpy, only the ones that are within 6 bytes of each other
+        need to be resolved one at a time, to tell which -128 bytes are part of another delta
+    """
+    u = b.view(np.uint8)
+    cands = np.flatnonzero(b==-128)
+    cands = cands[cands<len(b)-2]
+    # the length of the int16/int32 that would follow each candidate escape
+    long = ((b[cands+1]==0) & (b[cands+2]==-128))
+    ext = np.where(long, 6, 2)
+    real = np.ones(len(cands), dtype=bool)
+    end = -1   # the last byte of the last escape that is real
+    for i in np.flatnonzero(np.diff(cands)<=6)+1:
+        if real[i-1]:
+            end = cands[i-1]+ext[i-1]
+        if cands[i]<=end:
+            real[i] = False
+    cands,long,ext = cands[real],long[real],ext[real]
+    if np.any(cands+ext>=len(b)):
+        raise Exception("truncated byte-offset stream")
+
+    deltas = b.astype(np.int32)
+    keep = np.ones(len(b), dtype=bool)
+    s = cands[~long]
+    deltas[s] = (u[s+1].astype(np.int32) | (b[s+2].astype(np.int32)<<8))
+    keep[s+1] = keep[s+2] = False
+    s = cands[long]
+    if len(s)>0:
+        v = (u[s+3].astype(np.int64) | (u[s+4].astype(np.int64)<<8) | (u[s+5].astype(np.int64)<<16)
+             | (b[s+6].astype(np.int64)<<24))
+        if np.any(v==-2**31):
+            raise Exception("64-bit deltas are not supported")
+        deltas[s] = v
+        for j in range(1, 7):
+            keep[s+j] = False
+    return deltas[keep]
+
+def _byte_offset_decode_loop(b, out):
+    """ one pixel at a time, compiled with numba if it is available
+    """
+    n = len(b)
+    i = 0
+    j = 0
+    v = 0
+    while i<n and j<len(out):
+        d = np.int32(b[i])
+        i += 1
+        if d==-128:
+            if i+2>n:
+                break
+            d = (np.int32(b[i])&0xff) | (np.int32(b[i+1])<<8)
+            i += 2
+            if d==-32768:
+                if i+4>n:
+                    break
+                d = ((np.int32(b[i])&0xff) | ((np.int32(b[i+1])&0xff)<<8) | ((np.int32(b[i+2])&0xff)<<16)
+                     | (np.int32(b[i+3])<<24))
+                i += 4
+        v += d
+        out[j] = v
+        j += 1
+    return j
+
+if numba is not None:
+    _byte_offset_decode_loop = numba.njit(cache=True, nogil=True)(_byte_offset_decode_loop)
+
+def byte_offset_decode(b, out, use_numba=True):
+    """ decode the byte-offset stream b (int8) into out (1D, int32)
+    """
+    if numba is not None and use_numba:
+        n = _byte_offset_decode_loop(b, out)
+    else:
+        deltas = _byte_offset_deltas(b)
+        n = min(len(deltas), len(out))
+        np.cumsum(deltas[:n], out=out[:n])
+    if n!=len(out):
+        raise Exception(f"expected {len(out)} pixels, got {n}")
+    return out
+
+def cbf_read(fn, out=None, use_numba=True):
+    """ read the data in a Pilatus CBF file, into out if given, which must be int32 with the same
+        shape as the image (second, fastest dimension), e.g. (1043, 981)
+        only the MIME header just before the binary section is read
+    """
+    with open(fn, "rb") as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        pos = mm.find(cbf_binary_marker)
+        if pos<0:
+            raise Exception(f"no binary section in {fn}")
+        hstart = max(0, pos-4096)
+        if mm.find(b"x-CBF_BYTE_OFFSET", hstart, pos)<0:
+            raise Exception(f"{fn} does not use byte-offset compression")
+        nbytes = int(_cbf_header_value(mm, b"X-Binary-Size:", hstart, pos))
+        shape = (int(_cbf_header_value(mm, b"X-Binary-Size-Second-Dimension:", hstart, pos)),
+                 int(_cbf_header_value(mm, b"X-Binary-Size-Fastest-Dimension:", hstart, pos)))
+        if out is None:
+            out = np.empty(shape, dtype=np.int32)
+        elif out.shape!=shape or out.dtype!=np.int32:
+            raise Exception(f"expected a {shape} int32 buffer for {fn}")
+        b = np.frombuffer(mm, dtype=np.int8, count=nbytes, offset=pos+len(cbf_binary_marker))
+        byte_offset_decode(b, out.reshape(-1), use_numba)
+        del b   # the mmap cannot be closed while the array exists
+    finally:
+        try:
+            mm.close()
+        except BufferError:   # still referenced from a traceback, closed when that is released
+            pass
+    return out
+
+def cbf_complete(fn):
+    """ whether fn exists and has been written up to the end of the binary section
+    """
+    try:
+        with open(fn, "rb") as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):   # not there yet, or still empty
+        return False
+    try:
+        pos = mm.find(cbf_binary_marker)
+        if pos<0:
+            return False
+        try:
+            nbytes = int(_cbf_header_value(mm, b"X-Binary-Size:", max(0, pos-4096), pos))
+        except Exception:   # not a byte-offset CBF, leave it to the reader
+            return True
+        return len(mm)>=pos+len(cbf_binary_marker)+nbytes
+    finally:
+        mm.close()
+
+# inotify, through libc, see inotify(7)
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_libc = None
+
+def _inotify_libc():
+    """ libc, if it has inotify (Linux), otherwise None
+    """
+    global _libc
+    if _libc is None:
+        _libc = False
+        if sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+                libc.inotify_init1, libc.inotify_add_watch
+                _libc = libc
+            except (OSError, AttributeError):
+                pass
+    return _libc or None
+
+def wait_for_cbf(fn, timeout=30, poll_period=0.2, recheck_period=1.):
+    """ wait until the detector has finished writing fn, up to timeout seconds
+        returns True if the file is complete, False on timeout
+        with inotify, this returns as soon as the file is closed or renamed into place; inotify
+        does not see files written by other hosts on network file systems (e.g. GPFS), so the
+        file is also checked every recheck_period seconds; without inotify, or if the directory 
+        does not exist yet, the file is checked every poll_period seconds
+    """
+    t0 = time.time()
+    if cbf_complete(fn):
+        return True
+    libc = _inotify_libc()
+    fd = -1
+    if libc is not None:
+        fd = libc.inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+    try:
+        watching = False
+        while True:
+            if fd>=0 and not watching:
+                watching = libc.inotify_add_watch(fd, os.path.dirname(os.path.abspath(fn)).encode(), 
+                                                  IN_CLOSE_WRITE|IN_MOVED_TO)>=0
+            # the file may have been completed before the watch was in place
+            if cbf_complete(fn):
+                return True
+            remaining = timeout-(time.time()-t0)
+            if remaining<=0:
+                return False
+            if not watching:
+                time.sleep(min(poll_period, remaining))
+                continue
+            if select.select([fd], [], [], min(recheck_period, remaining))[0]:
+                buf = os.read(fd, 65536)
+                i = 0
+                name = os.path.basename(fn).encode()
+                while i<len(buf):
+                    wd,mask,cookie,n = struct.unpack_from("iIII", buf, i)
+                    if buf[i+16:i+16+n].rstrip(b"\0")==name and cbf_complete(fn):
+                        return True
+                    i += 16+n
+    finally:
+        if fd>=0:
+            os.close(fd)
+
+def verify_cbf_decoder(fns):
+    """ compare cbf_read() with fabio for the files in fns, returns the files that do not match
+    """
+    import fabio
+    failed = []
+    for fn in fns:
+        ref = fabio.open(fn).data
+        for use_numba in ([False, True] if numba is not None else [False]):
+            data = cbf_read(fn, use_numba=use_numba)
+            if data.shape!=ref.shape or not np.array_equal(data, ref):
+                print(f"{fn} does not match fabio, use_numba={use_numba}")
+                failed.append(fn)
+    print(f"{len(fns)-len(set(failed))} of {len(fns)} files decoded correctly.")
+    return failed
+
+def benchmark_cbf_decoder(work_dir=None, nframes=20, shape=(1043, 981), repeats=3):
+    """ decode nframes generated Pilatus-like frames, with fabio and cbf_read(), and report the
+        frames per second for each; the frames are written into work_dir (a temporary directory
+        by default)
+    """
+    import fabio,tempfile
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="cbf-benchmark-")
+    rng = np.random.default_rng(0)
+    y,x = np.indices(shape)
+    r = np.hypot(x-shape[1]/2, y-shape[0]/3)+10
+    fns = []
+    for i in range(nframes):
+        frame = rng.poisson(2e4/r**1.5).astype(np.int32)
+        frame[195::212, :] = -1
+        frame[rng.integers(0, shape[0], 20), rng.integers(0, shape[1], 20)] = 2**20  # hot pixels
+        fn = os.path.join(work_dir, f"bench_{i:06d}_SAXS.cbf")
+        fabio.cbfimage.CbfImage(data=frame).write(fn)
+        fns.append(fn)
+    if len(verify_cbf_decoder(fns))>0:
+        raise Exception("cbf_read() does not agree with fabio.")
+
+    readers = {"fabio": lambda fn,out: fabio.open(fn).data,
+               "numpy": lambda fn,out: cbf_read(fn, out, use_numba=False)}
+    if numba is not None:
+        readers["numba"] = lambda fn,out: cbf_read(fn, out)
+    out = np.empty(shape, dtype=np.int32)
+    results = {}
+    for name,reader in readers.items():
+        t0 = time.time()
+        for i in range(repeats):
+            for fn in fns:
+                reader(fn, out)
+        results[name] = repeats*nframes/(time.time()-t0)
+        print(f"{name:>6}: {results[name]:.1f} frames/s")
+    return results
+
+class CBFFrameCache:
+    """ decoded frames, so that the same CBF files are not decoded again, e.g. when a sample is 
+        packed again, or read by fetch_scan() after it has been packed
+        the entries are keyed by the absolute path, size and mtime of the file, so a file that is
+        changed or replaced is decoded again
+        the memory tier keeps up to max_bytes of frames in this process; the disk tier (if disk_dir 
+        is set, e.g. a local SSD) keeps up to disk_max_bytes as .npy files, which are shared by 
+        all processes that use the same directory and survive restarts; the frames are looked up
+        in the directory, the files written by other processes are picked up by the eviction 
+        every disk_scan_period seconds
+        the least recently used frames are dropped first; see stats() to tune the sizes
+        a frame read into out is copied into the cache, so this only pays off if the same files 
+        are read again; the cache is not used unless it is set for the handler, e.g.
+            PilatusCBFHandler.frame_cache = cbf_frame_cache
+    """
+    disk_scan_period = 60
+    
+    def __init__(self, max_bytes=1e9, disk_dir=None, disk_max_bytes=20e9):
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self._cache = collections.OrderedDict()
+        self._disk = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.disk_nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_dir = None
+        self._disk_scanned = 0
+        if disk_dir is not None:
+            self.set_disk_dir(disk_dir)
+    
+    def set_disk_dir(self, disk_dir):
+        """ use disk_dir for the disk tier, the frames already there are kept, oldest first
+        """
+        os.makedirs(disk_dir, exist_ok=True)
+        self.disk_dir = disk_dir
+        self._scan_disk()
+    
+    def _scan_disk(self):
+        """ list the frames in disk_dir, including those written by other processes, then evict
+        """
+        files = []
+        for e in os.scandir(self.disk_dir):
+            try:
+                if e.name.endswith(".npy"):
+                    st = e.stat()
+                    files.append((st.st_mtime, e.name, st.st_size))
+            except FileNotFoundError:   # removed by another process
+                pass
+        with self._lock:
+            self._disk.clear()
+            for mtime,name,size in sorted(files):
+                self._disk[name] = size
+            self.disk_nbytes = sum(self._disk.values())
+            self._disk_scanned = time.time()
+        self._evict_disk()
+    
+    def _evict(self):
+        while self.nbytes>self.max_bytes and len(self._cache)>0:
+            self.nbytes -= self._cache.popitem(last=False)[1].nbytes
+    
+    def _evict_disk(self):
+        while True:
+            with self._lock:
+                if self.disk_nbytes<=self.disk_max_bytes or len(self._disk)==0:
+                    return
+                name,size = self._disk.popitem(last=False)
+                self.disk_nbytes -= size
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+            except FileNotFoundError:   # removed by another process
+                pass
+    
+    def _put(self, key, name, data):
+        with self._lock:
+            if key not in self._cache.keys() and data.nbytes<=self.max_bytes:
+                self._cache[key] = data
+                self.nbytes += data.nbytes
+                self._evict()
+        if self.disk_dir is None:
+            return
+        fn = os.path.join(self.disk_dir, name)
+        if os.path.exists(fn):
+            return
+        tmp = f"{fn}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp, "wb") as fh:
+            np.save(fh, data)
+        os.replace(tmp, fn)
+        with self._lock:
+            if name not in self._disk.keys():
+                self._disk[name] = os.path.getsize(fn)
+                self.disk_nbytes += self._disk[name]
+        if time.time()-self._disk_scanned>self.disk_scan_period:
+            self._scan_disk()
+        else:
+            self._evict_disk()
+    
+    def read(self, fn, out=None, reader=cbf_read):
+        """ the frame in fn, into out if given; otherwise the array returned is read-only, since
+            it may be in the cache
+        """
+        fn = os.path.abspath(fn)
+        st = os.stat(fn)
+        key = (fn, st.st_size, st.st_mtime_ns)
+        name = hashlib.sha1(repr(key).encode()).hexdigest()+".npy"
+        data = None
+        with self._lock:
+            if key in self._cache.keys():
+                self._cache.move_to_end(key)
+                self.hits += 1
+                data = self._cache[key]
+        if data is None and self.disk_dir is not None:
+            try:
+                # the file may have been written by another process
+                data = np.load(os.path.join(self.disk_dir, name))
+                with self._lock:
+                    self.disk_hits += 1
+                    if name in self._disk.keys():
+                        self._disk.move_to_end(name)
+                    else:
+                        self._disk[name] = data.nbytes
+                        self.disk_nbytes += data.nbytes
+                data.setflags(write=False)
+                self._put(key, name, data)
+            except (OSError, ValueError):   # not there, or evicted by another process
+                data = None
+        if data is not None:
+            if out is None:
+                return data
+            np.copyto(out, data)
+            return out
+        
+        with self._lock:
+            self.misses += 1
+        ret = reader(fn, out)
+        data = ret.copy() if ret is out else ret
+        data.setflags(write=False)
+        self._put(key, name, data)
+        return ret
+    
+    def clear(self):
+        """ drop all frames from the memory tier, the disk tier is kept
+        """
+        with self._lock:
+            self._cache.clear()
+            self.nbytes = 0
+    
+    def stats(self):
+        with self._lock:
+            n = self.hits+self.disk_hits+self.misses
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "hit_rate": (self.hits+self.disk_hits)/n if n>0 else 0,
+                    "frames": len(self._cache), "bytes": self.nbytes, 
+                    "disk_frames": len(self._disk), "disk_bytes": self.disk_nbytes}
+
+cbf_frame_cache = CBFFrameCache()
@@ -1,8 +1,11 @@
-import os
+import os,re,functools,logging
+from concurrent.futures import ThreadPoolExecutor
 from databroker.assets.handlers_base import HandlerBase
 from databroker.assets.base_registry import DuplicateHandler
 import fabio
 
+cbf_logger = logging.getLogger("lix.cbf")
+
 # for backward compatibility, fpp was always 1 before Jan 2018
 #global pilatus_fpp
 #pilatus_fpp = 1
@@ -37,8 +40,33 @@ class PilatusCBFHandler(HandlerBase):
         'WAXS1': (619, 487),
         'WAXS2': (1043, 981)      # orignal WAXS2 was (619, 487)
     }
+    # for reading frames in parallel, see read_points() and prefetch()
+    # prefetching keeps up to read_ahead_frames frames (at least one point) in memory per handler, 
+    # 4 bytes per pixel, e.g. 16 SAXS frames take 65 MB
+    max_workers = min(8, os.cpu_count())
+    read_ahead_frames = 16
+    _pools = {}
+    # decoded frames, see CBFFrameCache, e.g. cbf_frame_cache; None to decode the files every time
+    frame_cache = None
+    # live mode: wait (up to live_timeout seconds) for the detector to write each file, see get_data()
+    live = False
+    live_timeout = 30
 
-    def __init__(self, rpath, template, filename, frame_per_point=1, initial_number=1):
+    def __init__(self, rpath, template, filename, frame_per_point=1, initial_number=1, 
+                 froot=None, trigger_mode=None, subdir=None, live=None, live_timeout=None):
+        """ froot, trigger_mode, subdir, live and live_timeout override the class attributes for 
+            this instance only, see cbf_handler_registry()
+        """
+        if froot is not None:
+            self.froot = froot
+        if trigger_mode is not None:
+            self.trigger_mode = trigger_mode
+        if subdir is not None:
+            self.subdir = subdir
+        if live is not None:
+            self.live = live
+        if live_timeout is not None:
+            self.live_timeout = live_timeout
         print(f'Initializing CBF handler for {self.trigger_mode} ...')
         self._template = template
         self._fpp = frame_per_point
@@ -47,6 +75,7 @@ class PilatusCBFHandler(HandlerBase):
         self._image_size = None
         self._default_path = os.path.join(rpath, '')
         self._path = ""
+        self._prefetched = {}
         
         for k in self.std_image_size:
             if template.find(k)>=0:
@@ -57,8 +86,10 @@ class PilatusCBFHandler(HandlerBase):
         for fr in data_file_path:
             if self._default_path.find(fr.value)==0:
                 self._dir = self._default_path[len(fr.value):]
-                return
-        raise Exception(f"invalid file path: {self._default_path}")
+                break
+        else:
+            raise Exception(f"invalid file path: {self._default_path}")
+        self._compile_filenames()
     
     def update_path(self):
         # this is a workaround for data that are save in /exp_path then moved to /nsls2/xf16id1/exp_path
@@ -67,9 +98,21 @@ class PilatusCBFHandler(HandlerBase):
         self._path = self.froot.value+self._dir 
         print(f"updating path, will read data from {self._path} ...")
     
-    def get_data(self, fn):
+    def get_data(self, fn, out=None):
         """ the file may not exist
+            the frame is decoded by cbf_read(), into out if given, and by fabio if that fails
+            the frames decoded by cbf_read() are kept in frame_cache
+            in live mode, e.g. to read the data while the scan is still running, this waits for 
+            the file to be written, instead of returning an empty frame if it is not there yet
         """
+        if self.live and not wait_for_cbf(fn, self.live_timeout):
+            raise Exception(f"timed out waiting for {fn}")
+        try:
+            if self.frame_cache is not None:
+                return self.frame_cache.read(fn, out)
+            return cbf_read(fn, out)
+        except Exception:
+            pass
         try:
             img = fabio.open(fn)
             data = img.data
@@ -81,10 +124,12 @@ class PilatusCBFHandler(HandlerBase):
         #print(data.shape)
         return data
         
-    def __call__(self, point_number):
-        start = self._initial_number #+ point_number
-        stop = start + 1 
-        ret = []
+    def _compile_filenames(self):
+        """ work out the file names once, from the template, trigger_mode, frame_per_point, froot
+            and subdir: self._fmt has a single field left, for the number that depends on the 
+            point, and self._offsets are added to the point number for each frame of the point
+        """
+        start = self._initial_number
 
         tplt = self._template.replace("6.6d", "06d") # some early templates are not correctly formatted
         tl = tplt.replace(".", "_").split("_") 
@@ -98,25 +143,133 @@ class PilatusCBFHandler(HandlerBase):
             tl = tl[:-2]+tl[-1:]
         self._template = "_".join(tl[:-1])+"."+tl[-1]
 
-        print("CBF handler called: start=%d, stop=%d" % (start, stop))
-        print("  ", self._initial_number, point_number, self._fpp)
-        print("  ", self._template, self._path, self._initial_number)
         self.update_path()
         if self.subdir is not None:
             self._path += f"{self.subdir}/"
      
+        # the values for the fields in the template, None for the one that depends on the point
         if self.trigger_mode == triggerMode.software_trigger_single_frame or self._fpp == 1:
-            fn = self._template % (self._path, self._filename, self._initial_number+point_number)
-            ret.append(self.get_data(fn))
+            values = [self._path, self._filename, None]
+            self._offsets = [self._initial_number]
         elif self.trigger_mode in [triggerMode.software_trigger_multi_frame,
                                       triggerMode.fly_scan]:
-            for i in range(self._fpp):
-                fn = self._template % (self._path, self._filename, start, point_number+i) 
-                ret.append(self.get_data(fn))
+            values = [self._path, self._filename, start, None]
+            self._offsets = list(range(self._fpp))
         elif self.trigger_mode==triggerMode.external_trigger:
-            fn = self._template % (self._path, self._filename, start, point_number)
-            ret.append(self.get_data(fn))
+            values = [self._path, self._filename, start, None]
+            self._offsets = [0]
+        else:
+            raise Exception(f"unsupported trigger mode: {self.trigger_mode}")
         
+        fields = list(re.finditer(r"%[-#0 +]*\d*(\.\d+)?[a-z]", self._template))
+        if len(fields)!=len(values):
+            raise Exception(f"unexpected CBF filename template: {self._template}")
+        fmt = ""
+        i = 0
+        for m,v in zip(fields, values):
+            fmt += self._template[i:m.start()].replace("%", "%%")
+            fmt += m.group(0) if v is None else (m.group(0) % v).replace("%", "%%")
+            i = m.end()
+        self._fmt = fmt + self._template[i:].replace("%", "%%")
+    
+    def _filenames(self, point_number):
+        """ the files that contain the frames for this point
+        """
+        return [self._fmt % (point_number+i) for i in self._offsets]
+    
+    @classmethod
+    def _pool(cls):
+        """ the thread pool shared by all handlers in this process, the frames are decoded there
+            a pool inherited through fork() has no threads, so there is one per process
+        """
+        pool = PilatusCBFHandler._pools.get(os.getpid())
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=cls.max_workers)
+            PilatusCBFHandler._pools[os.getpid()] = pool
+        return pool
+    
+    def _read_frame(self, fn, out):
+        """ a frame of the wrong size (e.g. from fabio, see get_data()) is cropped or padded with 
+            zeros to fit into out, instead of failing the whole read; a warning is logged to 
+            cbf_logger with the file name and both shapes
+        """
+        data = self.get_data(fn, out)
+        if data is out:
+            return
+        if data.shape==out.shape:
+            out[...] = data
+            return
+        out[...] = 0
+        if data.ndim!=out.ndim:
+            cbf_logger.warning(f"{fn}: the {data.shape} frame does not fit into {out.shape}, replaced by zeros")
+            return
+        cropped = [n1>n2 for n1,n2 in zip(data.shape, out.shape)]
+        padded = [n1<n2 for n1,n2 in zip(data.shape, out.shape)]
+        how = " and ".join([w for w,f in [("cropped", cropped), ("padded with zeros", padded)] if any(f)])
+        cbf_logger.warning(f"{fn}: the {data.shape} frame is {how} to fit into {out.shape}")
+        sl = tuple(slice(0, min(n1, n2)) for n1,n2 in zip(data.shape, out.shape))
+        out[sl] = data[sl]
+    
+    def _submit(self, fns):
+        """ start decoding the frames in fns into one preallocated array, (len(fns), h, w)
+            returns the array and the futures, one per frame
+        """
+        data = np.empty((len(fns), *self._image_size), dtype=np.int32)
+        return data,[self._pool().submit(self._read_frame, fn, out) for fn,out in zip(fns, data)]
+    
+    def _read(self, fns):
+        """ decode the frames in fns in parallel, (len(fns), h, w)
+        """
+        data,futures = self._submit(fns)
+        for fut in futures:
+            fut.result()
+        return data
+    
+    def read_points(self, point_numbers):
+        """ the data for a list of points, stacked into one array, as if __call__ was called for 
+            each point; the file names are resolved first, then all frames are decoded in parallel
+        """
+        nf = len(self._offsets)
+        data = self._read(np.char.mod(self._fmt, np.add.outer(point_numbers, self._offsets)).ravel().tolist())
+        if nf==1:
+            return data
+        return data.reshape((len(point_numbers), nf, *self._image_size))
+    
+    @property
+    def read_ahead(self):
+        """ the number of points that prefetch() reads ahead, read_ahead_frames in total
+        """
+        return max(1, self.read_ahead_frames//len(self._offsets))
+    
+    def prefetch(self, datum_kwargs):
+        """ start decoding the frames for the datums that will be read next, in the background
+            used by _read_datum_sources() to read ahead; at most read_ahead points are kept
+        """
+        for dk in datum_kwargs:
+            pn = dk['point_number']
+            if pn in self._prefetched.keys() or len(self._prefetched)>=self.read_ahead:
+                continue
+            self._prefetched[pn] = self._submit(self._filenames(pn))
+        
+    def __call__(self, point_number):
+        if point_number in self._prefetched.keys():
+            data,futures = self._prefetched.pop(point_number)
+            for fut in futures:
+                fut.result()
+            return data.squeeze()
+        ret = [self.get_data(fn) for fn in self._filenames(point_number)]
         return np.array(ret).squeeze()
 
 db.reg.register_handler('AD_CBF', PilatusCBFHandler, overwrite=True)
+
+def cbf_handler_registry(reg=None, **kwargs):
+    """ a copy of the handler registry, with the AD_CBF handler configured using kwargs 
+        (froot, trigger_mode, subdir, live, live_timeout), e.g. for pack_h5(handler_registry=...)
+        this avoids changing the class attributes of PilatusCBFHandler, which are shared by all 
+        packing jobs running at the same time
+    """
+    if reg is None:
+        reg = db.reg.handler_reg
+    reg = dict(reg)
+    reg['AD_CBF'] = functools.partial(reg['AD_CBF'], **kwargs)
+    return reg
@@ -0,0 +1,64 @@
+import numpy as np
+from py4xs.slnxs import Data1d
+from py4xs.hdf import merge_d1s,pack_d1
+
+# azimuthal averaging of the detector images while they are packed, see pack_and_move(reduce=True)
+# the 1D data are written in the same layout as h5xs.load_data()/save_d1s(), so that they can be
+# read using h5xs.load_d1s() as soon as the file is packed
+
+# the data fields for each detector, same as py4xs.local.det_names, with or without "_ext"
+reducer_det_names = {"_SAXS": ["pil1M_image", "pil1M_ext_image"],
+                     "_WAXS1": ["pilW1_image", "pilW1_ext_image"],
+                     "_WAXS2": ["pilW2_image", "pilW2_ext_image"]}
+
+class H5Reducer:
+    """ azimuthal averaging of the detector images while they are exported, see hdf5_export(reducer=...)
+        each frame is reduced to 1D using the detector configuration and qgrid (e.g. from exp.h5),
+        as in py4xs.hdf.proc_merge1d(); the data from all detectors are then merged, and written
+        into the processed group of the sample, as h5xs.save_d1s() would
+        the transmitted intensity is not known here (transField, monitors), 'trans' is left for
+        h5xs to set, see h5xs.set_trans()
+    """
+    def __init__(self, detectors, qgrid, det_names=reducer_det_names):
+        self.qgrid = qgrid
+        self.detectors = [det for det in detectors if det.extension in det_names.keys()]
+        self.dets = {k: det for det in self.detectors for k in det_names[det.extension]}
+        self.keys = list(self.dets.keys())
+        self._d1s = {det.extension: [] for det in self.detectors}
+
+    def frame(self, key, frame):
+        det = self.dets[key]
+        frame = np.asarray(frame)
+        for img in frame.reshape(-1, *frame.shape[-2:]):
+            d1 = Data1d()
+            # merge_d1s() expects the labels of the data from the same frame to have a common prefix
+            label = "_f%05d%s" % (len(self._d1s[det.extension]), det.extension)
+            d1.load_from_2D(img, det.exp_para, self.qgrid, pre_process=det.pre_process,
+                            flat_cor=det.flat, mask=det.exp_para.mask, save_ave=False, label=label)
+            if det.dark is not None:
+                d1.data -= det.dark
+            if det.fix_scale is not None:
+                d1.scale(1./det.fix_scale)
+            self._d1s[det.extension].append(d1)
+
+    def end(self, group):
+        """ processed/<detector extension> and processed/merged: [intensity, error] for each frame
+        """
+        d1s = {ext: d for ext,d in self._d1s.items() if len(d)>0}
+        self._d1s = {det.extension: [] for det in self.detectors}
+        if len(d1s)==0:
+            return
+        dets = [det for det in self.detectors if det.extension in d1s.keys()]
+        nframes = set([len(d) for d in d1s.values()])
+        if len(nframes)>1:
+            raise Exception(f"the detectors have different numbers of frames: {nframes}")
+        d1s["merged"] = [merge_d1s([d1s[det.extension][i] for det in dets], dets)
+                         for i in range(nframes.pop())]
+        grp = group.require_group("processed")
+        for k,d in d1s.items():
+            data,tvs = pack_d1(d)
+            if k in grp.keys():
+                del grp[k]
+            grp.create_dataset(k, data=data)
+            if (np.asarray(tvs)>0).any():
+                grp[k].attrs['trans'] = tvs
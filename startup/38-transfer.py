@@ -0,0 +1,537 @@
+import os,time,shlex,shutil,hashlib,subprocess,threading,logging,socket
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor,as_completed
+import bluesky.plan_stubs as bps
+
+# moving the detector data from the RAMDISK on the detector server to GPFS
+# all files for a set of uids are listed in one call, then copied in several parallel streams; the
+# source files are deleted only after the copies have been verified
+# the SSH backend keeps one persistent (ControlMaster) connection to the detector server, the local
+# backend does the same on the local file system, e.g. for testing
+#    ramdisk_transfer.move("/ramdisk/...", "/nsls2/xf16id1/data/...", ["holder1"])
+
+class LocalTransferBackend:
+    """ source and destination are both on the local file system
+        bandwidth (bytes/sec), if given, slows down the copies, e.g. to mimic the network
+    """
+    def __init__(self, bandwidth=None):
+        self.bandwidth = bandwidth
+
+    def list_files(self, src_root, names):
+        """ [(path relative to src_root, size), ...]
+            for each name, all files under the directory src_root/name if it exists, otherwise
+            the files in src_root that match name_*.*
+        """
+        files = []
+        for name in names:
+            path = os.path.join(src_root, name)
+            if os.path.isdir(path):
+                for dp,dns,fns in os.walk(path):
+                    for fn in sorted(fns):
+                        fp = os.path.join(dp, fn)
+                        files.append((os.path.relpath(fp, src_root), os.path.getsize(fp)))
+            elif os.path.isdir(src_root):
+                pre = os.path.basename(name)+"_"
+                d = os.path.dirname(path)
+                for fn in sorted(os.listdir(d)):
+                    fp = os.path.join(d, fn)
+                    if fn.startswith(pre) and "." in fn[len(pre):] and os.path.isfile(fp):
+                        files.append((os.path.relpath(fp, src_root), os.path.getsize(fp)))
+        return files
+
+    def copy(self, src_root, dest_root, files):
+        for fn in files:
+            dest = os.path.join(dest_root, fn)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            t0 = time.time()
+            shutil.copy2(os.path.join(src_root, fn), dest)
+            if self.bandwidth:
+                time.sleep(max(0, os.path.getsize(dest)/self.bandwidth-(time.time()-t0)))
+
+    def checksums(self, src_root, files):
+        return {fn: file_md5(os.path.join(src_root, fn)) for fn in files}
+
+    def remove(self, src_root, files):
+        for fn in files:
+            os.remove(os.path.join(src_root, fn))
+
+    def disk_usage(self, path):
+        """ (used, total) bytes of the file system
+        """
+        st = os.statvfs(path)
+        return (st.f_blocks-st.f_bavail)*st.f_frsize, st.f_blocks*st.f_frsize
+
+    def close(self):
+        pass
+
+
+class SSHTransferBackend:
+    """ the source is on a remote host, all commands go through one persistent ssh connection
+        the data are copied using rsync over the same connection
+    """
+    def __init__(self, host, control_path="~/.ssh/lix-transfer-%r@%h:%p", persist=600):
+        self.host = host
+        self.ssh_opts = ["-q", "-o", "BatchMode=yes", "-o", "ControlMaster=auto",
+                         "-o", f"ControlPath={os.path.expanduser(control_path)}",
+                         "-o", f"ControlPersist={persist}"]
+
+    def run(self, script, stdin=b""):
+        """ run the shell script on the remote host, returns stdout
+        """
+        ret = subprocess.run(["ssh", *self.ssh_opts, self.host, "bash", "-c", shlex.quote(script)],
+                             input=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if ret.returncode!=0:
+            raise Exception(f"ssh {self.host} failed ({ret.returncode}): {ret.stderr.decode().strip()}")
+        return ret.stdout
+
+    def list_files(self, src_root, names):
+        """ same as LocalTransferBackend.list_files(), in one ssh call
+        """
+        script = f"cd {shlex.quote(src_root)} || exit 1\n"
+        for name in names:
+            q = shlex.quote(name)
+            script += (f"if [ -d {q} ]; then find {q} -type f -printf '%s\\t%p\\0'; "
+                       f"else find {shlex.quote(os.path.dirname(name) or '.')} -maxdepth 1 -type f "
+                       f"-name {shlex.quote(os.path.basename(name)+'_*.*')} -printf '%s\\t%p\\0'; fi\n")
+        files = []
+        for rec in self.run(script).decode().split("\0"):
+            if rec=="":
+                continue
+            size,fn = rec.split("\t", 1)
+            files.append((os.path.normpath(fn), int(size)))
+        return files
+
+    def copy(self, src_root, dest_root, files):
+        ssh = " ".join(["ssh"]+[shlex.quote(o) for o in self.ssh_opts])
+        os.makedirs(dest_root, exist_ok=True)
+        ret = subprocess.run(["rsync", "-a", "--from0", "--files-from=-", "-e", ssh,
+                              f"{self.host}:{os.path.join(src_root, '')}", os.path.join(dest_root, '')],
+                             input="\0".join(files).encode(), stderr=subprocess.PIPE)
+        if ret.returncode!=0:
+            raise Exception(f"rsync failed ({ret.returncode}): {ret.stderr.decode().strip()}")
+
+    def checksums(self, src_root, files):
+        out = self.run(f"cd {shlex.quote(src_root)} && xargs -0 -r md5sum --", "\0".join(files).encode())
+        ret = {}
+        for line in out.decode().splitlines():
+            md5,fn = line.split(None, 1)
+            ret[os.path.normpath(fn.lstrip("*"))] = md5
+        return ret
+
+    def remove(self, src_root, files):
+        self.run(f"cd {shlex.quote(src_root)} && xargs -0 -r rm -f --", "\0".join(files).encode())
+
+    def disk_usage(self, path):
+        used,avail = self.run(f"df -B1 --output=used,avail {shlex.quote(path)} | tail -1").split()
+        return int(used), int(used)+int(avail)
+
+    def close(self):
+        subprocess.run(["ssh", *self.ssh_opts, "-O", "exit", self.host],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def file_md5(fn, bufsize=1<<22):
+    h = hashlib.md5()
+    with open(fn, "rb") as fp:
+        for buf in iter(lambda: fp.read(bufsize), b""):
+            h.update(buf)
+    return h.hexdigest()
+
+class TransferManager:
+    """ move files from src_root to dest_root using the backend
+        streams: number of copies running at the same time
+        verify: "checksum" (md5) or "size", the source file is deleted only if its copy matches
+        batch_size: number of files in each copy, the progress is reported after each batch
+    """
+    def __init__(self, backend, streams=4, verify="checksum", batch_size=200):
+        if verify not in ["checksum", "size"]:
+            raise Exception(f"invalid verify option: {verify}")
+        self.backend = backend
+        self.streams = streams
+        self.verify = verify
+        self.batch_size = batch_size
+
+    def _batches(self, files):
+        """ group the files into batches of up to batch_size files, with similar numbers of bytes
+        """
+        nb = max(self.streams, int(np.ceil(len(files)/self.batch_size)))
+        batches = [[] for i in range(nb)]
+        sizes = np.zeros(nb)
+        for fn,size in sorted(files, key=lambda x: -x[1]):
+            i = np.argmin(sizes)
+            batches[i].append(fn)
+            sizes[i] += size
+        return [b for b in batches if len(b)>0]
+
+    def _verified(self, src_root, dest_root, files):
+        """ the files (of [(fn, size), ...]) whose copies match the source
+        """
+        sizes = {}
+        for fn,size in files:
+            dest = os.path.join(dest_root, fn)
+            if os.path.isfile(dest) and os.path.getsize(dest)==size:
+                sizes[fn] = size
+        if self.verify=="size" or len(sizes)==0:
+            return list(sizes.keys())
+        fns = list(sizes.keys())
+        with ThreadPoolExecutor(self.streams) as ex:
+            src_md5 = ex.submit(self.backend.checksums, src_root, fns)
+            dest_md5 = dict(zip(fns, ex.map(lambda fn: file_md5(os.path.join(dest_root, fn)), fns)))
+            src_md5 = src_md5.result()
+        return [fn for fn in fns if src_md5.get(fn)==dest_md5[fn]]
+
+    def _move_batch(self, src_root, dest_root, batch):
+        """ copy, verify, then delete the source of the verified files, returns the verified files
+        """
+        try:
+            self.backend.copy(src_root, dest_root, [fn for fn,size in batch])
+        except Exception as e:
+            print(f"copy failed: {e}")
+        ok = self._verified(src_root, dest_root, batch)
+        if len(ok)>0:
+            self.backend.remove(src_root, ok)
+        return ok
+
+    def move(self, src_root, dest_root, names, progress=None, retries=1):
+        """ names: see LocalTransferBackend.list_files()
+            progress, if given, is called as progress(bytes_done, bytes_total) after each batch
+            files that could not be copied/verified are kept at the source
+            returns {"files": ..., "bytes": ..., "time": ..., "failed": [...]}
+        """
+        t0 = time.time()
+        files = self.backend.list_files(src_root, names)
+        sizes = dict(files)
+        total = sum(sizes.values())
+        print(f"moving {len(files)} files ({total/1e6:.1f} MB) from {src_root} to {dest_root} ...")
+        done = 0
+        pending = files
+        moved = []
+        for attempt in range(retries+1):
+            if len(pending)==0:
+                break
+            with ThreadPoolExecutor(self.streams) as ex:
+                futures = [ex.submit(self._move_batch, src_root, dest_root, [(fn,sizes[fn]) for fn in b])
+                           for b in self._batches(pending)]
+                for fut in as_completed(futures):
+                    ok = fut.result()
+                    moved += ok
+                    done += sum([sizes[fn] for fn in ok])
+                    if progress is not None:
+                        progress(done, total)
+            pending = [(fn,size) for fn,size in pending if fn not in set(moved)]
+
+        dt = time.time()-t0
+        print(f"moved {len(moved)} files, {done/1e6:.1f} MB in {dt:.1f} sec ({done/1e6/max(dt, 1e-6):.1f} MB/s)")
+        if len(pending)>0:
+            print(f"{len(pending)} files could not be moved and are kept at the source.")
+        return {"files": len(moved), "bytes": done, "time": dt, "failed": [fn for fn,size in pending]}
+
+ramdisk_transfer = TransferManager(SSHTransferBackend("det@10.16.0.14"))
+
+
+ramdisk_logger = logging.getLogger("lix.ramdisk")
+
+class RamdiskClaims:
+    """ make sure the same files on the RAMDISK are never moved by two processes at the same time, 
+        e.g. the early move by RamdiskMonitor in the beamline session and pack_and_move() on the 
+        packing server; a process claims the files (a directory, or the files of a sample, see 
+        ramdisk_claim_keys()) before moving them, and releases the claim once they are moved
+        a claim is a file in path, which must be visible to all these processes (i.e. on GPFS), 
+        created with O_EXCL, with the host name and pid of the holder in it
+        the holder touches its claims every refresh_period sec; a claim is taken over if it is left 
+        by a process on the same host that is no longer running, or if it has not been touched 
+        for stale_after sec (a process on another host that died)
+    """
+    def __init__(self, path, stale_after=300, refresh_period=60, poll_period=2):
+        self.path = path
+        self.stale_after = stale_after
+        self.refresh_period = refresh_period
+        self.poll_period = poll_period
+        self._held = set()
+        self._lock = threading.Lock()
+        self._refresh_pid = None
+    
+    def _fn(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode()).hexdigest())
+    
+    def _stale(self, fn):
+        """ returns the content of the claim file if the claim is stale, otherwise None
+        """
+        with open(fn) as fh:
+            content = fh.read()
+        if time.time()-os.path.getmtime(fn)>self.stale_after:
+            return content
+        try:
+            host,pid = content.split()[:2]
+            pid = int(pid)
+        except ValueError:   # being written
+            return None
+        if host!=socket.gethostname() or pid==os.getpid():
+            return None
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return content
+        except PermissionError:   # running, as another user
+            pass
+        return None
+    
+    def _take_over(self, fn, content):
+        """ remove the stale claim, unless another process has taken it over in the meantime
+        """
+        tmp = f"{fn}.{socket.gethostname()}.{os.getpid()}"
+        os.rename(fn, tmp)
+        with open(tmp) as fh:
+            taken = fh.read()
+        if taken==content:
+            os.remove(tmp)
+        else:   # claimed again just now, put it back
+            os.rename(tmp, fn)
+    
+    def _try_acquire(self, key):
+        fn = self._fn(key)
+        try:
+            fd = os.open(fn, os.O_CREAT|os.O_EXCL|os.O_WRONLY, 0o666)
+        except FileExistsError:
+            try:
+                content = self._stale(fn)
+                if content is None:
+                    return False
+                ramdisk_logger.warning("taking over a stale claim on %s: %s", key, content.strip())
+                self._take_over(fn, content)
+            except FileNotFoundError:   # just released
+                pass
+            return self._try_acquire(key)
+        os.write(fd, f"{socket.gethostname()} {os.getpid()} {key}\n".encode())
+        os.close(fd)
+        with self._lock:
+            self._held.add(key)
+        return True
+    
+    def _refresh(self):
+        """ runs in a thread: touch the claims held by this process, so that they are not stale
+        """
+        while True:
+            time.sleep(self.refresh_period)
+            with self._lock:
+                keys = list(self._held)
+            for key in keys:
+                try:
+                    os.utime(self._fn(key))
+                except FileNotFoundError:
+                    pass
+    
+    def acquire(self, keys, timeout=None):
+        """ claim all keys, waiting up to timeout sec (forever if None) for other processes to 
+            release them; returns False if they could not all be claimed, none is held then
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock:
+            # a thread started before fork() does not run in the child
+            if self._refresh_pid!=os.getpid():
+                self._held = set()
+                self._refresh_pid = os.getpid()
+                threading.Thread(target=self._refresh, daemon=True).start()
+        keys = sorted(set(keys))   # the same order in every process
+        held = []
+        t0 = time.time()
+        for key in keys:
+            while not self._try_acquire(key):
+                if timeout is not None and time.time()-t0>=timeout:
+                    self.release(held)
+                    return False
+                time.sleep(self.poll_period)
+            held.append(key)
+        return True
+    
+    def release(self, keys):
+        for key in set(keys):
+            with self._lock:
+                self._held.discard(key)
+            try:
+                os.remove(self._fn(key))
+            except FileNotFoundError:
+                pass
+
+ramdisk_claims = RamdiskClaims(os.path.join(data_file_path.gpfs.value, ".ramdisk-claims"))
+
+class RamdiskMonitor:
+    """ keep track of the free space on the RAMDISK and of the rate data are written into it
+        the rate is measured from the change in disk usage, and from the frame counters of the 
+        Pilatus HDF plugins (frames/sec x frame size)
+        above the high-water mark (fraction of the capacity), the files of the scans that have 
+        been sent to the packing queue with move_first=True are moved to GPFS early; packing 
+        moves whatever is left later, the two never move the same files at once, see RamdiskClaims
+        check_scan() is the hook for LiXDetectors.capacity_check: before the run is opened, make 
+        sure the data expected from the scan will fit; action="warn" only logs a warning, "hold" waits 
+        in the plan (up to hold_timeout sec) for space to be freed, then raises an exception
+    """
+    def __init__(self, path=data_file_path.ramdisk.value, backend=None, high_water=0.7, reserve=0.1,
+                 period=10, window=60, action="warn", hold_timeout=600):
+        if action not in ["warn", "hold"]:
+            raise Exception(f"invalid action: {action}")
+        self.path = path
+        self.backend = LocalTransferBackend() if backend is None else backend
+        self.high_water = high_water
+        self.reserve = reserve
+        self.period = period
+        self.window = window
+        self.action = action
+        self.hold_timeout = hold_timeout
+        self.detectors = []
+        self._samples = []   # (time, bytes used, bytes from the HDF plugins)
+        self._pending = []   # uids whose files can be moved early
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def add_uids(self, uids):
+        """ scans that have been collected, and whose files can be moved to GPFS any time
+        """
+        with self._lock:
+            self._pending += [u for u in uids if u not in self._pending]
+    
+    def remove_uids(self, uids):
+        """ these are being moved already
+        """
+        with self._lock:
+            self._pending = [u for u in self._pending if u not in uids]
+    
+    def _plugin_bytes(self):
+        nb = 0
+        for det in self.detectors:
+            try:
+                shape = PilatusCBFHandler.std_image_size[det.detector_id]
+                nb += det.hdf.array_counter.get()*4*shape[0]*shape[1]
+            except Exception:
+                pass
+        return nb
+
+    def sample(self):
+        """ record the disk usage, returns (used, total, rate), rate in bytes/sec from disk usage
+        """
+        used,total = self.backend.disk_usage(self.path)
+        t = time.time()
+        with self._lock:
+            self._samples.append((t, used, self._plugin_bytes()))
+            self._samples = [s for s in self._samples if s[0]>t-self.window]
+        return used,total,self.rates()[0]
+
+    def rates(self):
+        """ (from disk usage, from the HDF plugins), in bytes/sec over the last window sec
+            only increases count, the usage drops when files are moved away
+        """
+        with self._lock:
+            samples = list(self._samples)
+        if len(samples)<2:
+            return 0.,0.
+        dt = samples[-1][0]-samples[0][0]
+        du = sum([max(0, s1[1]-s0[1]) for s0,s1 in zip(samples[:-1], samples[1:])])
+        dp = sum([max(0, s1[2]-s0[2]) for s0,s1 in zip(samples[:-1], samples[1:])])
+        return du/dt,dp/dt
+
+    def move_early(self):
+        """ move the files of the pending uids to GPFS
+        """
+        with self._lock:
+            uids,self._pending = self._pending,[]
+        if len(uids)==0:
+            return 0
+        ramdisk_logger.info("moving the files for %d scans to GPFS early ...", len(uids))
+        holders = {}
+        for uid in uids:
+            holders.setdefault(db[uid].start.get('holderName'), []).append(uid)
+        nbytes = 0
+        for dir_name,us in holders.items():
+            try:
+                keys = ramdisk_claim_keys(us, dir_name)
+                if not ramdisk_claims.acquire(keys, timeout=0):
+                    ramdisk_logger.info("the files for %s are being moved by another process", us)
+                    continue
+                try:
+                    nbytes += sum([st['bytes'] for st in move_files_from_RAMDISK(us, dir_name)])
+                finally:
+                    ramdisk_claims.release(keys)
+            except Exception as e:
+                ramdisk_logger.error("could not move the files for %s: %s", us, e)
+        return nbytes
+
+    def check(self):
+        used,total,rate = self.sample()
+        ramdisk_logger.debug("RAMDISK: %.1f of %.1f GB used, %.1f MB/s (disk), %.1f MB/s (HDF plugins)",
+                             used/1e9, total/1e9, rate/1e6, self.rates()[1]/1e6)
+        if used>self.high_water*total:
+            ramdisk_logger.warning("RAMDISK above the high-water mark (%.0f%%): %.1f of %.1f GB used, %.1f MB/s",
+                                   self.high_water*100, used/1e9, total/1e9, rate/1e6)
+            self.move_early()
+        return used,total
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.check()
+            except Exception as e:
+                ramdisk_logger.error("RAMDISK check failed: %s", e)
+            self._stop.wait(self.period)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        ramdisk_logger.info("monitoring %s: high-water mark %.0f%%, reserve %.0f%%, every %d sec", 
+                            self.path, self.high_water*100, self.reserve*100, self.period)
+
+    def stop(self):
+        self._stop.set()
+
+    def check_scan(self, nbytes):
+        """ nbytes: the data expected from the scan
+            this is called from the RunEngine, it should not block: the files that can be moved 
+            early are moved in the background; with action="hold", returns a plan that waits for 
+            space, otherwise None
+            if the RAMDISK cannot be checked, e.g. it is not mounted, only log a warning, this 
+            should never prevent the scan from running
+        """
+        try:
+            used,total,rate = self.sample()
+        except OSError as e:
+            ramdisk_logger.warning("could not check the space on the RAMDISK: %s", e)
+            return None
+        if used+nbytes<=(1-self.reserve)*total:
+            return None
+        msg = (f"the RAMDISK may overflow: {used/1e9:.1f} of {total/1e9:.1f} GB used, "
+               f"{nbytes/1e9:.1f} GB expected from the scan")
+        ramdisk_logger.warning(msg)
+        threading.Thread(target=self.move_early, daemon=True).start()
+        if self.action=="warn":
+            return None
+        return self._wait_for_space(nbytes, msg)
+    
+    def _wait_for_space(self, nbytes, msg):
+        """ a plan that waits until nbytes fit on the RAMDISK, the RunEngine can be paused or 
+            aborted while it waits; raises an exception after hold_timeout sec
+        """
+        t0 = time.time()
+        while True:
+            used,total,rate = self.sample()
+            if used+nbytes<=(1-self.reserve)*total:
+                break
+            if time.time()-t0>self.hold_timeout:
+                raise Exception(msg)
+            ramdisk_logger.info("waiting for space on the RAMDISK: %.1f of %.1f GB used ...", used/1e9, total/1e9)
+            yield from bps.checkpoint()
+            yield from bps.sleep(self.period)
+        ramdisk_logger.info("enough space on the RAMDISK after %.0f sec", time.time()-t0)
+
+ramdisk_monitor = RamdiskMonitor()
+try:
+    ramdisk_monitor.detectors = list(pil.dets.values())
+except NameError:   # the detectors were not initialized
+    pass
+if os.path.isdir(ramdisk_monitor.path):
+    LiXDetectors.capacity_check = ramdisk_monitor.check_scan
+    if ramdisk_capacity_wrapper not in RE.preprocessors:
+        RE.preprocessors.append(ramdisk_capacity_wrapper)
+    ramdisk_monitor.start()
@@ -15,6 +15,14 @@ import copy
 from databroker import Header
 import copy
 import dask.dataframe as dd
+import os,time,hashlib,functools
+import multiprocessing,threading
+from queue import Queue,Empty
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
 
 def conv_to_list(d): 
     if isinstance(d, float) or isinstance(d, int) or isinstance(d, str): 
@@ -35,9 +43,542 @@ def update_res_path(res_path, replace_res_path={}):
             res_path = res_path.replace(rp1, rp2)  
     return res_path
 
+class H5CodecPolicy:
+    """ compression used for the datasets in the packed h5 file, by field class:
+            "images":  2D or larger data per event, e.g. Pilatus frames
+            "spectra": 1D data per event, e.g. Xspress3 spectra
+            "scalars": everything else, including time stamps
+        a codec is specified by name: "gzip" (same as "gzip-4"), "gzip-1" ... "gzip-9", "lzf", 
+            "bslz4" (bitshuffle+lz4), "bszstd" (bitshuffle+zstd), "zstd", or "none"
+        the last 3 require hdf5plugin, which must also be available to read the file
+        data copied from AD_HDF5 resources keep the compression used by the IOC
+        strings (e.g. sample names) are "scalars" as well
+        
+        e.g. H5CodecPolicy(images="bslz4", fletcher32={"images": False})
+    """
+    field_classes = ["images", "spectra", "scalars"]
+    
+    def __init__(self, images="gzip", spectra="gzip", scalars="gzip", fletcher32=True):
+        self.codecs = {"images": images, "spectra": spectra, "scalars": scalars}
+        if isinstance(fletcher32, dict):
+            self.fletcher32 = {fc: fletcher32.get(fc, True) for fc in self.field_classes}
+        else:
+            self.fletcher32 = {fc: fletcher32 for fc in self.field_classes}
+        for fc in self.field_classes:
+            self.codec_kwargs(self.codecs[fc])   # fail early for invalid/unavailable codecs 
+    
+    @staticmethod
+    def codec_kwargs(codec):
+        """ keyword arguments for h5py's create_dataset() to use the named codec
+        """
+        if codec=="none":
+            return {}
+        elif codec=="lzf":
+            return {"compression": "lzf"}
+        elif codec=="gzip" or codec[:5]=="gzip-":
+            level = 4 if codec=="gzip" else int(codec[5:])
+            return {"compression": "gzip", "compression_opts": level}
+        elif codec in ["bslz4", "bszstd", "zstd"]:
+            if hdf5plugin is None:
+                raise Exception(f"hdf5plugin is required for {codec}.")
+            if codec=="bslz4":
+                return dict(hdf5plugin.Bitshuffle(cname='lz4'))
+            elif codec=="bszstd":
+                return dict(hdf5plugin.Bitshuffle(cname='zstd'))
+            return dict(hdf5plugin.Zstd())
+        raise Exception(f"unknown codec: {codec}")
+    
+    @classmethod
+    def field_class(cls, frame):
+        """ the field class for the data of a single event
+        """
+        ndim = np.ndim(frame)
+        if ndim>=2:
+            return "images"
+        elif ndim==1:
+            return "spectra"
+        return "scalars"
+    
+    def kwargs(self, field_class):
+        kw = self.codec_kwargs(self.codecs[field_class])
+        if self.fletcher32[field_class]:
+            kw["fletcher32"] = True
+        return kw
+    
+    def create_dataset(self, group, key, field_class, **kwargs):
+        """ create the dataset using the codec for the field class, and record the codec in attrs
+        """
+        dataset = group.create_dataset(key, **kwargs, **self.kwargs(field_class))
+        dataset.attrs['codec'] = self.codecs[field_class]
+        dataset.attrs['fletcher32'] = self.fletcher32[field_class]
+        return dataset
+    
+class ResourceIndex:
+    """ resource and datum documents, looked up by uid and cached, so that the resources used by 
+        a run can be found without streaming all documents of the run via header.documents()
+        the lookup goes through, whichever is available first:
+            the asset registry (db.reg.resource_given_uid(), db.reg.datum_gen_given_resource())
+            the mongo collections behind the v2 catalog, a single query for all uids
+            header.documents(), as a last resort
+        the root of each resource is mapped using the root_map of the catalog (e.g. old_gpfs->gpfs), 
+        as databroker does when the data are filled
+    """
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._resources = collections.OrderedDict()
+        self._datums = collections.OrderedDict()
+    
+    def _cache(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache)>self.maxsize:
+            cache.popitem(last=False)
+    
+    def _root_map(self, header):
+        root_map = getattr(header.db.reg, "root_map", None)
+        if root_map is None:
+            root_map = getattr(getattr(header.db, "v2", None), "root_map", None)
+        return root_map or {}
+    
+    def _fetch_resources(self, header, uids):
+        reg = header.db.reg
+        if hasattr(reg, "resource_given_uid"):
+            return {uid: dict(reg.resource_given_uid(uid)) for uid in uids}
+        coll = getattr(getattr(header.db, "v2", None), "_resource_collection", None)
+        if coll is not None:
+            return {d['uid']: d for d in coll.find({'uid': {'$in': uids}}, {'_id': False})}
+        return {d['uid']: d for n,d in header.documents() if n=="resource" and d['uid'] in uids}
+    
+    def _fetch_datums(self, header, res):
+        reg = header.db.reg
+        if hasattr(reg, "datum_gen_given_resource"):
+            return [dict(d) for d in reg.datum_gen_given_resource(res)]
+        coll = getattr(getattr(header.db, "v2", None), "_datum_collection", None)
+        if coll is not None:
+            return list(coll.find({'resource': res['uid']}, {'_id': False}))
+        return [d for n,d in header.documents() if n=="datum" and d['resource']==res['uid']]
+        
+    def resources(self, header, uids):
+        """ {uid: resource document} for the resource uids
+        """
+        found = {}
+        for uid in uids:
+            if uid in self._resources:
+                found[uid] = self._resources[uid]
+                self._resources.move_to_end(uid)
+        missing = [uid for uid in uids if uid not in found]
+        if len(missing)>0:
+            root_map = self._root_map(header)
+            for uid,res in self._fetch_resources(header, missing).items():
+                root = res.get('root', '')
+                if root in root_map.keys():
+                    res = dict(res, root=root_map[root])
+                found[uid] = res
+                self._cache(self._resources, uid, res)
+        return {uid: found[uid] for uid in uids}
+    
+    def datums(self, header, res_uid, datum_ids=[]):
+        """ {datum_id: datum document} for all datums of the resource
+            a resource may get more datums while the run is in progress; the datums are fetched
+            again if any of datum_ids is not among those cached
+        """
+        if res_uid in self._datums:
+            self._datums.move_to_end(res_uid)
+            if all([datum_id in self._datums[res_uid] for datum_id in datum_ids]):
+                return self._datums[res_uid]
+        res = self.resources(header, [res_uid])[res_uid]
+        datums = {d['datum_id']: d for d in self._fetch_datums(header, res)}
+        self._cache(self._datums, res_uid, datums)
+        return datums
+    
+    def clear(self):
+        self._resources.clear()
+        self._datums.clear()
+
+resource_index = ResourceIndex()
+
+class EventColumns:
+    """ the events of a descriptor/stream, organized in columns in a single pass over the events
+        time, seq_num: numpy arrays 
+        timestamps: {key: numpy array}
+        data: {key: list of values}, as they appear in the events
+        filled: the keys that refer to external data, the values in data are then the datum ids
+        
+        column(key) returns the data for key as a numpy array
+    """
+    def __init__(self, events, keys=None):
+        events = list(events)
+        if len(events)==0:
+            raise Exception("no events to build the columns from.")
+        if keys is None:
+            keys = list(events[0]['data'].keys())
+        self.keys = list(keys)
+        self.filled = [k for k in events[0].get('filled', {}).keys() if k in self.keys]
+
+        n = len(events)
+        time = [None]*n
+        seq_num = [None]*n
+        self.data = {k: [None]*n for k in self.keys}
+        self.timestamps = {k: [None]*n for k in self.keys}
+        for i,ev in enumerate(events):
+            time[i] = ev['time']
+            seq_num[i] = ev['seq_num']
+            d = ev['data']
+            ts = ev['timestamps']
+            for k in self.keys:
+                self.data[k][i] = d[k]
+                self.timestamps[k][i] = ts[k]
+        self.time = np.array(time)
+        self.seq_num = np.array(seq_num)
+        self.timestamps = {k: np.array(v) for k,v in self.timestamps.items()}
+        self._arrays = {}
+        
+    def __len__(self):
+        return len(self.time)
+    
+    def column(self, key):
+        if key not in self._arrays:
+            try:
+                self._arrays[key] = np.array(self.data[key])
+            except ValueError:   # ragged
+                self._arrays[key] = np.array(self.data[key], dtype=object)
+        return self._arrays[key]
+    
+    def resource_uids(self, key):
+        """ unique resource uids for a filled key, in the order they first appear
+        """
+        return list(dict.fromkeys(datum_id.split("/")[0] for datum_id in self.data[key]))
+            
+def _iter_frames(dset):
+    """ the 2D frames in an image dataset, e.g. (N, nframes, h, w), one at a time
+    """
+    for idx in np.ndindex(*dset.shape[:-2]):
+        yield dset[idx]
+
+def _frame_block(frame):
+    """ the block that np.vstack() would append for this frame, at least 2D
+    """
+    frame = np.asarray(frame)
+    if frame.ndim<2:
+        frame = frame[np.newaxis]
+    return frame
+
+def stream_filled_data(header, stream_name, key, data_group, nevents, codecs=None, 
+                       columns=None, handler_registry=None, on_frame=None):
+    """ fill the data for key one event at a time and write each frame into the dataset
+        as soon as it is read, so that peak memory does not depend on the number of frames
+        the dataset is pre-allocated from the shape/dtype of the first frame, and has the 
+        same layout as np.vstack() over all events
+        if columns (EventColumns) is given, the data are read using datum_sources() and 
+        handler_registry, instead of filling the events through databroker
+        on_frame, if given, is called with each frame as it is written
+        
+        returns None if the filled data are not arrays, nothing is written in that case
+    """
+    if codecs is None:
+        codecs = H5CodecPolicy()
+    if columns is None:
+        frames = (ev['data'][key] for ev in header.events(stream_name=stream_name, fields=[key], fill=True))
+    else:
+        frames = _read_datum_sources(*datum_sources(header, key, columns, handler_registry))
+    dataset = None
+    n = 0
+    for frame in frames:
+        if dataset is None:
+            if not isinstance(frame, np.ndarray):
+                return None
+            blk = _frame_block(frame)
+            chunks = (1, *blk.shape[1:]) if blk.ndim>2 else blk.shape
+            dataset = codecs.create_dataset(
+                data_group, key, H5CodecPolicy.field_class(frame),
+                shape=(nevents*blk.shape[0], *blk.shape[1:]), 
+                maxshape=(None, *blk.shape[1:]), dtype=blk.dtype, chunks=chunks)
+            print("data shape: ", dataset.shape, "     chunks: ", chunks)
+        else:
+            blk = _frame_block(frame)
+        if on_frame is not None:
+            on_frame(frame)
+        if n+len(blk)>dataset.shape[0]:
+            dataset.resize(n+len(blk), axis=0)
+        dataset[n:n+len(blk)] = blk
+        n += len(blk)
+        
+    if dataset is not None and n<dataset.shape[0]:
+        dataset.resize(n, axis=0)
+    return dataset
+        
+def datum_sources(header, key, columns, handler_registry=None):
+    """ [(resource document, datum_kwargs), ...] for each event, for the filled key
+        together with the handler class for each resource spec, these are all that is needed 
+        to read the data, without access to databroker
+    """
+    if handler_registry is None:
+        handler_registry = header.db.reg.handler_reg
+    res_uids = columns.resource_uids(key)
+    res_docs = resource_index.resources(header, res_uids)
+    datum_ids = {ru: [] for ru in res_uids}
+    for datum_id in columns.data[key]:
+        datum_ids[datum_id.split("/")[0]].append(datum_id)
+    datums = {}
+    for ru in res_uids:
+        datums.update(resource_index.datums(header, ru, datum_ids[ru]))
+    sources = [(res_docs[datum_id.split("/")[0]], datums[datum_id]['datum_kwargs']) 
+               for datum_id in columns.data[key]]
+    handlers = {res['spec']: handler_registry[res['spec']] for res in res_docs.values()}
+    return sources,handlers
+
+def _read_datum_sources(sources, handlers):
+    """ yield the data for each (resource, datum_kwargs), one handler instance per resource
+        handlers that can read ahead (e.g. PilatusCBFHandler.prefetch()) are given the 
+        datum_kwargs of the next datums from the same resource, before each datum is read
+    """
+    hdict = {}
+    for i,(res,datum_kwargs) in enumerate(sources):
+        if res['uid'] not in hdict:
+            fpath = os.path.join(res.get('root', ''), res['resource_path'])
+            hdict[res['uid']] = handlers[res['spec']](fpath, **res['resource_kwargs'])
+        handler = hdict[res['uid']]
+        if hasattr(handler, "prefetch"):
+            handler.prefetch([dk for r,dk in sources[i:i+handler.read_ahead] if r['uid']==res['uid']])
+        yield handler(**datum_kwargs)
+
+def _field_export_worker(key, sources, handlers, codecs, queue, scratch_blocks=100):
+    """ runs in a worker process: read the data for key, compress each block into a scratch 
+        in-memory h5 file that uses the same codec as the packed file, then hand the compressed 
+        chunks to the writer through the queue
+    """
+    n = 0
+    try:
+        scratch = None
+        for i,frame in enumerate(_read_datum_sources(sources, handlers)):
+            if not isinstance(frame, np.ndarray):
+                queue.put(("skip", key, None))
+                return
+            blk = _frame_block(frame)
+            if i==0:
+                shape = blk.shape
+                chunks = (1, *shape[1:]) if blk.ndim>2 else shape
+                fc = H5CodecPolicy.field_class(frame)
+                queue.put(("meta", key, (len(sources)*shape[0], *shape[1:]), blk.dtype.str, chunks, fc))
+            elif blk.shape!=shape:
+                raise Exception(f"inconsistent data shape for {key}: {blk.shape} vs {shape}")
+            if i%scratch_blocks==0:  # compressed chunks are re-allocated, start over once in a while
+                if scratch is not None:
+                    scratch.close()
+                scratch = h5py.File(f"scratch-{key}-{os.getpid()}.h5", "w", driver="core", backing_store=False)
+                dset = codecs.create_dataset(scratch, "data", fc, shape=shape, dtype=blk.dtype, chunks=chunks)
+            dset[...] = blk
+            for j in range(0, shape[0], chunks[0]):
+                offset = (j, *[0]*(blk.ndim-1))
+                filter_mask,chunk = dset.id.read_direct_chunk(offset)
+                queue.put(("chunk", key, (n+j, *offset[1:]), filter_mask, chunk))
+            n += shape[0]
+        queue.put(("done", key, n))
+    except Exception as e:
+        queue.put(("error", key, f"{type(e).__name__}: {e}"))
+
+def export_fields_parallel(header, keys, columns, data_group, data_keys={}, codecs=None, 
+                           workers=2, max_memory=None, handler_registry=None):
+    """ export the filled keys using a pool of worker processes, one key per worker
+        the workers read and compress the data, this process owns the h5 file and writes the 
+        compressed chunks as they arrive
+        max_memory (bytes) limits the number of workers and the chunks waiting to be written, 
+            based on the shapes in data_keys (from the descriptor), or the largest Pilatus frame 
+        returns the keys that have been written, the others should be exported serially 
+    """
+    if codecs is None:
+        codecs = H5CodecPolicy()
+    frame_bytes = 4*1043*981
+    shapes = [data_keys[k].get('shape') for k in keys if k in data_keys]
+    if len(shapes)>0 and all(shapes):
+        frame_bytes = max([4*int(np.prod(sh)) for sh in shapes])
+    queue_size = 64
+    if max_memory is not None:
+        # each worker holds a frame and its compressed copy
+        workers = max(1, min(workers, int(max_memory/(3*frame_bytes))))
+        queue_size = max(1, int((max_memory-workers*2*frame_bytes)/frame_bytes))
+    print(f"exporting {keys} using {workers} workers, up to {queue_size} chunks in the queue ...")
+    
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue(queue_size)
+    pending = list(keys)
+    running = {}
+    datasets = {}
+    written = []
+    try:
+        while len(pending)>0 or len(running)>0:
+            while len(pending)>0 and len(running)<workers:
+                key = pending.pop(0)
+                sources,handlers = datum_sources(header, key, columns, handler_registry)
+                p = ctx.Process(target=_field_export_worker, args=(key, sources, handlers, codecs, queue))
+                p.start()
+                running[key] = p
+            try:
+                msg = queue.get(timeout=10)
+            except Empty:
+                for key,p in running.items():
+                    if not p.is_alive():
+                        raise Exception(f"worker for {key} exited unexpectedly: {p.exitcode}")
+                continue
+            cmd,key = msg[:2]
+            if cmd=="chunk":
+                offset,filter_mask,chunk = msg[2:]
+                dset = datasets[key]
+                if offset[0]>=dset.shape[0]:
+                    dset.resize(offset[0]+dset.chunks[0], axis=0)
+                dset.id.write_direct_chunk(offset, chunk, filter_mask)
+            elif cmd=="meta":
+                shape,dtype,chunks,fc = msg[2:]
+                datasets[key] = codecs.create_dataset(
+                    data_group, key, fc, shape=shape, maxshape=(None, *shape[1:]), 
+                    dtype=np.dtype(dtype), chunks=chunks)
+                print(f"{key}: data shape: {shape}     chunks: {chunks}")
+            elif cmd=="done":
+                datasets[key].resize(msg[2], axis=0)
+                written.append(key)
+                running.pop(key).join()
+            elif cmd=="skip":
+                running.pop(key).join()
+            elif cmd=="error":
+                raise Exception(f"failed to export {key}: {msg[2]}")
+    finally:
+        for p in running.values():
+            p.terminate()
+            p.join()
+    
+    return written
+
+def _chunk_layout(dset):
+    """ filter pipeline, chunk shape and data type, compressed chunks can be copied verbatim 
+        between datasets that have the same layout
+    """
+    dcpl = dset.id.get_create_plist()
+    filters = tuple(dcpl.get_filter(i)[:3] for i in range(dcpl.get_nfilters()))
+    return filters, dset.chunks, dset.dtype
+
+def _create_stack_like(group, key, src, N):
+    """ create a dataset of shape (N, *src.shape), with the same data type and filter pipeline 
+        as src, and chunks of shape (1, *src.chunks)
+    """
+    src_dcpl = src.id.get_create_plist()
+    dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+    dcpl.set_chunk((1, *(src.chunks or src.shape)))
+    for i in range(src_dcpl.get_nfilters()):
+        code, flags, values, name = src_dcpl.get_filter(i)
+        dcpl.set_filter(code, flags, values)
+    space = h5py.h5s.create_simple((N, *src.shape))
+    dsid = h5py.h5d.create(group.id, key.encode(), src.id.get_type(), space, dcpl=dcpl)
+    return h5py.Dataset(dsid)
+
+def copy_h5_resources(fns, group, key, data_path="/entry/data/data"):
+    """ stack data_path from each of the files in fns into group[key], shape (N, *data.shape)
+        the compressed chunks are moved verbatim when the filter pipeline and the chunk shape 
+        of the source match those of the first file, otherwise the data are decoded and 
+        compressed again
+        all files must have the same shape of data_path, an exception is raised otherwise
+        
+        returns the dataset and the number of bytes (as stored in the source files) that were 
+        passed through or recompressed
+    """
+    stats = {"passthrough": 0, "recompressed": 0}
+    dataset = None
+    for i,fn in enumerate(fns):
+        with h5py.File(fn, "r") as hf5:
+            data = hf5[data_path]
+            if dataset is None:
+                dataset = _create_stack_like(group, key, data, len(fns))
+                layout = _chunk_layout(data)
+            if data.shape!=dataset.shape[1:]:
+                # e.g. a short resource from an aborted run, the missing frames would be left empty
+                raise Exception(f"{fn}: shape of {data_path} is {data.shape}, expected {dataset.shape[1:]}")
+            nbytes = data.id.get_storage_size()
+            if (data.chunks is not None and _chunk_layout(data)==layout
+                and hasattr(data.id, "get_chunk_info")):
+                for j in range(data.id.get_num_chunks()):
+                    offset = data.id.get_chunk_info(j).chunk_offset
+                    filter_mask,chunk = data.id.read_direct_chunk(offset)
+                    dataset.id.write_direct_chunk((i, *offset), chunk, filter_mask)
+                stats["passthrough"] += nbytes
+            else:
+                for j in range(len(data)):
+                    dataset[i,j] = data[j]
+                stats["recompressed"] += nbytes
+    
+    return dataset,stats
+
+def link_h5_resources(fns, group, key, data_path="/entry/data/data"):
+    """ expose data_path in the files as a virtual dataset group[key], without copying the data
+        the shape is (N, *data.shape) if there are more than one file, same as copy_h5_resources()
+    """
+    with h5py.File(fns[0], "r") as hf5:
+        shape = hf5[data_path].shape
+        dtype = hf5[data_path].dtype
+    if len(fns)==1:
+        layout = h5py.VirtualLayout(shape=shape, dtype=dtype)
+        layout[...] = h5py.VirtualSource(fns[0], data_path, shape=shape)
+    else:
+        layout = h5py.VirtualLayout(shape=(len(fns), *shape), dtype=dtype)
+        for i,fn in enumerate(fns):
+            layout[i] = h5py.VirtualSource(fn, data_path, shape=shape)
+    return group.create_virtual_dataset(key, layout, fillvalue=0)
+
+def _create_column_dataset(data_group, key, value, rawdata, codecs):
+    """ write the data for key from all events at once, value is the data key in the descriptor
+        rawdata is a list (one entry per event) or a pandas Series, as returned by header.table()
+        strings are written as fixed-length byte strings, using the codec for "scalars"
+    """
+    data = np.array(rawdata)
+
+    if value['dtype'].lower() == 'string':  # 1D of string
+        data_len = len(data[0])
+        data = data.astype('|S'+str(data_len))
+        dataset = codecs.create_dataset(data_group, key, "scalars", data=data)
+    elif data.dtype.kind in ['S', 'U']:
+        # 2D of string, we can't tell from dytpe, they are shown as array only.
+        if data.ndim == 2:
+            data_len = 1
+            for v in data[0]:
+                data_len = max(data_len, len(v))
+            data = data.astype('|S'+str(data_len))
+            dataset = codecs.create_dataset(data_group, key, "scalars", data=data)
+        else:
+            raise ValueError('Array of str with ndim >= 3 can not be saved.')
+    else:  # save numerical data
+        try:                               
+            if isinstance(rawdata, list):
+                blk = rawdata[0]
+            else: 
+                blk = rawdata[1]
+            if isinstance(blk, np.ndarray): # detector image
+                data = np.vstack(rawdata)
+                chunks = np.ones(len(data.shape), dtype=int)
+                n = len(blk.shape)
+                if chunks[-1]<10:
+                    chunks[-3:] = data.shape[-3:]
+                else:
+                    chunks[-2:] = data.shape[-2:]
+                chunks = tuple(chunks)
+                print("data shape: ", data.shape, "     chunks: ", chunks)
+                dataset = codecs.create_dataset(
+                    data_group, key, H5CodecPolicy.field_class(blk), 
+                    data=data, chunks=chunks)
+            else: # motor positions etc.
+                data = np.array(conv_to_list(rawdata)) # issue with list of lists
+                chunks = False
+                dataset = codecs.create_dataset(
+                    data_group, key, "scalars", data=data)
+        except:
+            raise
+        #    print("failed to convert data: ")
+        #    print(np.array(conv_to_list(rawdata)))
+        #    continue
+    return dataset
+
 def hdf5_export(headers, filename,
            stream_name=None, fields=None, bulk_h5_res=True,
-           timestamps=True, use_uid=True, db=None, replace_res_path={}):
+           timestamps=True, use_uid=True, db=None, replace_res_path={}, 
+           streaming=False, mode="copy", codecs=None, sample_name_as_group=False, append=False,
+           workers=0, worker_memory=None, handler_registry=None, reducer=None):
     """
     Create hdf5 file to preserve the structure of databroker.
 
@@ -64,6 +605,34 @@ def hdf5_export(headers, filename,
         db should be included in hdr.
     replace_res_path: in case the resource has been moved, specify how the path should be updated
         e.g. replace_res_path = {"exp_path/hdf": "nsls2/xf16id1/data/2022-1"}
+    streaming : Bool, optional
+        write filled (non-AD_HDF5) detector images frame by frame as the events are read,
+        instead of reading the entire stack into memory first
+    mode : string, optional
+        "copy" (default) copies the data from AD_HDF5 resources into the file
+        "virtual" creates virtual datasets that point to the resource files instead, 
+        see h5_materialize() to make the file self-contained later
+    codecs : H5CodecPolicy, optional
+        compression for images, spectra and scalars, default is gzip with fletcher32
+    sample_name_as_group : Bool, optional
+        name the top-level group after the sample name in the start document, if there is one
+    append : Bool, optional
+        update an existing file: runs that are already in the file, with the same uid and 
+        stop document, are skipped; other runs are added, or replace the group of the same name
+    workers : int, optional
+        with streaming, the number of worker processes that read and compress filled fields 
+        (e.g. SAXS and WAXS images) in parallel, 0 to export them one at a time in this process
+    worker_memory : int, optional
+        the memory (in bytes) the workers and the chunks waiting to be written may use
+    handler_registry : dict, optional
+        {spec: handler} used to read the filled fields, instead of the handlers registered with
+        databroker, e.g. to configure the handlers for this export only
+    reducer : optional
+        processes the data as they are exported, in the same pass, see H5Reducer; an object with
+            keys: the fields it needs
+            frame(key, frame): called with each frame of these fields, in order
+            end(group): called once all descriptors of a header are exported, with the top-level 
+                group, to write the results
         
     Revision 2021 May
         Now that the resource is a h5 file, copy data directly from the file 
@@ -71,8 +640,13 @@ def hdf5_export(headers, filename,
     """
     if isinstance(headers, Header):
         headers = [headers]
+    if mode not in ["copy", "virtual"]:
+        raise ValueError(f"invalid export mode: {mode}")
+    if codecs is None:
+        codecs = H5CodecPolicy()
 
-    with h5py.File(filename, "w") as f:
+    with h5py.File(filename, "a" if append else "w") as f:
+        written = []
         for header in headers:
             try:
                 db = header.db
@@ -81,23 +655,32 @@ def hdf5_export(headers, filename,
             if db is None:
                 raise RuntimeError('db is not defined in header, so we need to input db explicitly.')
                 
-            res_docs = {}
-            for n,d in header.documents():
-                if n=="resource":
-                    res_docs[d['uid']] = d
-
             try:
                 descriptors = header.descriptors
             except KeyError:
                 warnings.warn("Header with uid {header.uid} contains no "
                               "data.".format(header), UserWarning)
                 continue
-            if use_uid:
+            if sample_name_as_group and 'sample_name' in header.start.keys():
+                top_group_name = header.start['sample_name']
+            elif use_uid:
                 top_group_name = header.start['uid']
             else:
                 top_group_name = 'data_' + str(header.start['scan_id'])
+            if top_group_name in written:
+                raise Exception(f"duplicate group name: {top_group_name}")
+            written.append(top_group_name)
+            
+            checksum = _stop_checksum(header.stop)
+            if top_group_name in f.keys():
+                if _h5_run_matches(f[top_group_name], header.start['uid'], checksum):
+                    print(f"{top_group_name} is already up to date, skipping ...")
+                    continue
+                print(f"replacing {top_group_name} ...")
+                del f[top_group_name]
             group = f.create_group(top_group_name)
             _safe_attrs_assignment(group, header)
+            group.attrs['stop_checksum'] = checksum
             for i, descriptor in enumerate(descriptors):
                 # make sure it's a dictionary and trim any spurious keys
                 descriptor = dict(descriptor)
@@ -116,25 +699,31 @@ def hdf5_export(headers, filename,
                 _safe_attrs_assignment(desc_group, descriptor)
 
                 # fill can be bool or list
-                events = list(header.events(stream_name=descriptor['name'], fill=False))
-
-                res_dict = {}
-                if "filled" in events[0].keys():
-                    for k in list(events[0]['filled'].keys()):
-                        res_dict[k] = []
-                        for ev in events:
-                            res_uid = ev['data'][k].split("/")[0]
-                            if not res_uid in res_dict[k]:
-                                res_dict[k].append(res_uid)
-                        
-                event_times = [e['time'] for e in events]
-                desc_group.create_dataset('time', data=event_times,
-                                          compression='gzip', fletcher32=True)
+                keys = [k for k in data_keys.keys() if fields is None or k in fields]
+                columns = EventColumns(header.events(stream_name=descriptor['name'], fill=False), keys)
+
+                res_dict = {k: columns.resource_uids(k) for k in columns.filled}
+                res_docs = resource_index.resources(header, list(set(sum(res_dict.values(), []))))
+                codecs.create_dataset(desc_group, 'time', "scalars", data=columns.time)
                 data_group = desc_group.create_group('data')
                 if timestamps:
                     ts_group = desc_group.create_group('timestamps')
 
+                parallel_keys = []
+                if streaming and workers>0:
+                    # the frames for the reducer must be read in this process
+                    parallel_keys = [k for k in res_dict.keys() 
+                                     if (res_docs[res_dict[k][0]]['spec']!="AD_HDF5" or not bulk_h5_res)
+                                     and (reducer is None or k not in reducer.keys)]
+                    if len(parallel_keys)>0:
+                        parallel_keys = export_fields_parallel(header, parallel_keys, columns, data_group, 
+                                                               data_keys, codecs, workers, worker_memory,
+                                                               handler_registry)
+                
                 for key, value in data_keys.items():
+                    on_frame = None
+                    if reducer is not None and key in reducer.keys:
+                        on_frame = functools.partial(reducer.frame, key)
                     print(f"processing {key} ...")
                     if fields is not None:
                         if key not in fields:
@@ -142,95 +731,397 @@ def hdf5_export(headers, filename,
                             continue
                     print(f"creating dataset for {key} ...")
                     if timestamps:
-                        timestamps = [e['timestamps'][key] for e in events]
-                        ts_group.create_dataset(key, data=timestamps,
-                                                compression='gzip',
-                                                fletcher32=True)
+                        codecs.create_dataset(ts_group, key, "scalars", data=columns.timestamps[key])
 
-                    if key in list(res_dict.keys()):
+                    if key in parallel_keys:
+                        rawdata = None
+                        dataset = data_group[key]
+                    elif key in list(res_dict.keys()):
                         res = res_docs[res_dict[key][0]] 
                         if res['spec'] == "AD_HDF5" and bulk_h5_res:
                             rawdata = None
                             N = len(res_dict[key])
-                            if N==1:
-                                res = res_docs[res_dict[key][0]]
-                                hf5 = h5py.File(res["root"]+update_res_path(res["resource_path"], replace_res_path), "r")
+                            fns = [res_docs[ru]["root"]+update_res_path(res_docs[ru]["resource_path"], replace_res_path) 
+                                   for ru in res_dict[key]]
+                            if mode=="virtual":
+                                dataset = link_h5_resources(fns, data_group, key)
+                            elif N==1:
+                                hf5 = h5py.File(fns[0], "r")
                                 data = hf5["/entry/data/data"]
                                 data_group.copy(data, key)
                                 hf5.close()
                                 dataset = data_group[key]
                             else: # ideally this should never happen, only 1 hdf5 file/resource per scan
-                                for i in range(N):
-                                    res = res_docs[res_dict[key][i]]
-                                    hf5 = h5py.File(res["root"]+update_res_path(res["resource_path"], replace_res_path), "r")
-                                    data = hf5["/entry/data/data"]
-                                    if i==0:
-                                        dataset = data_group.create_dataset(
-                                                key, shape=(N, *data.shape), 
-                                                compression=data.compression,
-                                                chunks=(1, *data.chunks))
-                                    dataset[i,:] = data
-                                    hf5.close()
+                                dataset,stats = copy_h5_resources(fns, data_group, key)
+                                print(f"   {stats['passthrough']/1e6:.1f} MB passed through, "
+                                      f"{stats['recompressed']/1e6:.1f} MB recompressed")
+                            if on_frame is not None:
+                                # the chunks were copied without decoding; one frame at a time
+                                for frame in _iter_frames(dataset):
+                                    on_frame(frame)
                         else:
-                            rawdata = header.table(stream_name=descriptor['name'], 
-                                                   fields=[key], fill=True)[key]   # this returns the time stamps as well
+                            rawdata = None
+                            dataset = None
+                            if streaming:
+                                dataset = stream_filled_data(header, descriptor['name'], key, 
+                                                             data_group, len(columns), codecs,
+                                                             columns, handler_registry, on_frame)
+                            if dataset is None and handler_registry is not None:
+                                rawdata = list(_read_datum_sources(
+                                    *datum_sources(header, key, columns, handler_registry)))
+                            elif dataset is None:
+                                rawdata = header.table(stream_name=descriptor['name'], 
+                                                       fields=[key], fill=True)[key]   # this returns the time stamps as well
+                            if rawdata is not None and on_frame is not None:
+                                for frame in rawdata:
+                                    on_frame(frame)
                     else:
-                        rawdata = [e['data'][key] for e in events]
+                        rawdata = columns.data[key]
 
                     if rawdata is not None:
-                        data = np.array(rawdata)
-
-                        if value['dtype'].lower() == 'string':  # 1D of string
-                            data_len = len(data[0])
-                            data = data.astype('|S'+str(data_len))
-                            dataset = data_group.create_dataset(
-                                key, data=data, compression='gzip')
-                        elif data.dtype.kind in ['S', 'U']:
-                            # 2D of string, we can't tell from dytpe, they are shown as array only.
-                            if data.ndim == 2:
-                                data_len = 1
-                                for v in data[0]:
-                                    data_len = max(data_len, len(v))
-                                data = data.astype('|S'+str(data_len))
-                                dataset = data_group.create_dataset(
-                                    key, data=data, compression='gzip')
-                            else:
-                                raise ValueError('Array of str with ndim >= 3 can not be saved.')
-                        else:  # save numerical data
-                            try:                               
-                                if isinstance(rawdata, list):
-                                    blk = rawdata[0]
-                                else: 
-                                    blk = rawdata[1]
-                                if isinstance(blk, np.ndarray): # detector image
-                                    data = np.vstack(rawdata)
-                                    chunks = np.ones(len(data.shape), dtype=int)
-                                    n = len(blk.shape)
-                                    if chunks[-1]<10:
-                                        chunks[-3:] = data.shape[-3:]
-                                    else:
-                                        chunks[-2:] = data.shape[-2:]
-                                    chunks = tuple(chunks)
-                                    print("data shape: ", data.shape, "     chunks: ", chunks)
-                                    dataset = data_group.create_dataset(
-                                        key, data=data,
-                                        compression='gzip', fletcher32=True, chunks=chunks)
-                                else: # motor positions etc.
-                                    data = np.array(conv_to_list(rawdata)) # issue with list of lists
-                                    chunks = False
-                                    dataset = data_group.create_dataset(
-                                        key, data=data, 
-                                        compression='gzip', fletcher32=True)
-                            except:
-                                raise
-                            #    print("failed to convert data: ")
-                            #    print(np.array(conv_to_list(rawdata)))
-                            #    continue
+                        dataset = _create_column_dataset(data_group, key, value, rawdata, codecs)
 
                     # Put contents of this data key (source, etc.)
                     # into an attribute on the associated data set.
                     _safe_attrs_assignment(dataset, dict(value))
 
+            if reducer is not None:
+                reducer.end(group)
+
+
+def _unpack_page(page, fields):
+    """ the documents in an event_page or datum_page, one at a time
+        fields are the entries that are lists in the page, the rest are dictionaries of lists
+    """
+    n = len(page[fields[0]])
+    for i in range(n):
+        doc = {k: v for k,v in page.items() if not isinstance(v, (list, dict))}
+        for k,v in page.items():
+            if k in fields:
+                doc[k] = v[i]
+            elif isinstance(v, dict):
+                doc[k] = {kk: vv[i] for kk,vv in v.items()}
+        yield doc
+
+class LiveH5Serializer:
+    """ a RunEngine callback that packs each run into a h5 file while the run is in progress, 
+        with the same layout as hdf5_export(use_uid=False, sample_name_as_group=True), e.g.
+            reg = cbf_handler_registry(trigger_mode=triggerMode.external_trigger)
+            live_packer = LiveH5Serializer(dest_dir, reg, fields=pack_h5_default_fields)
+            RE.subscribe(live_packer)
+        
+        handler_registry is required, the handlers must be configured for the scans (e.g. the 
+        trigger mode, see pack_and_move()); it can also be a function that returns the registry 
+        for the start document of each run
+        
+        the documents are queued and written by a background thread, so that the RunEngine is 
+        never held up by file I/O; the images in filled fields are read using handler_registry 
+        and appended to the file as the events arrive, read_delay seconds after the event; the 
+        handlers that have a live mode (PilatusCBFHandler) are switched to it, so that they wait 
+        for the detector to write the files, and raise an exception for a file that is missing, 
+        instead of returning an empty frame; the scalars are written after the stop document, 
+        together with the data in AD_HDF5 resources, which can only be copied once the IOC has 
+        closed the file (waiting up to file_timeout seconds for that)
+        
+        the file is written as .<name>.h5.live in dest_dir, then renamed to <name>.h5 and passed 
+        to on_complete(fn), if given; <name> is the sample name, or the uid of the run
+        the .live file is removed if the run does not end successfully, if packing fails, or if 
+        the serializer is closed before the stop document is received
+    """
+    def __init__(self, dest_dir, handler_registry, fields=None, timestamps=True, codecs=None, 
+                 replace_res_path={}, read_delay=1., file_timeout=60, flush_period=5, on_complete=None):
+        if handler_registry is None:
+            raise Exception("handler_registry is required, e.g. cbf_handler_registry(trigger_mode=...)")
+        self.dest_dir = dest_dir
+        self.fields = fields
+        self.timestamps = timestamps
+        self.codecs = H5CodecPolicy() if codecs is None else codecs
+        self.handler_registry = handler_registry
+        self.replace_res_path = replace_res_path
+        self.read_delay = read_delay
+        self.file_timeout = file_timeout
+        self.flush_period = flush_period
+        self.on_complete = on_complete
+        self.completed = []
+        self._queue = Queue()
+        self._thread = None
+        self._run = None
+    
+    def __call__(self, name, doc):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+        self._queue.put((name, doc))
+    
+    def wait(self):
+        """ block until all documents received so far have been written
+        """
+        self._queue.join()
+    
+    def close(self):
+        """ stop the background thread, once the documents received so far have been written
+            the file of a run that is still in progress is abandoned
+        """
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put((None, None))
+            self._thread.join()
+        self._thread = None
+    
+    def _abandon(self):
+        """ close and remove the .live file of the current run
+        """
+        run,self._run = self._run,None
+        print(f"   abandoning {run['tmp_fn']} ...")
+        run['file'].close()
+        if os.path.exists(run['tmp_fn']):
+            os.remove(run['tmp_fn'])
+    
+    def _worker(self):
+        while True:
+            try:
+                # wake up at least every 0.1 sec to read the pending frames, without spinning
+                name,doc = self._queue.get(timeout=max(self.read_delay, 0.1))
+            except Empty:
+                if self._run is not None:
+                    self._try("pending", self._read_pending)
+                continue
+            if name is None:
+                if self._run is not None:
+                    print(f"{self._run['fn']} was not complete when the serializer was closed")
+                    self._abandon()
+                self._queue.task_done()
+                return
+            if name=="event_page":
+                for ev in _unpack_page(doc, ["uid", "time", "seq_num"]):
+                    self._try(name, self.event, ev)
+            elif name=="datum_page":
+                for datum in _unpack_page(doc, ["datum_id"]):
+                    self._try(name, self.datum, datum)
+            elif hasattr(self, name):
+                self._try(name, getattr(self, name), doc)
+            self._queue.task_done()
+    
+    def _try(self, name, func, *args):
+        """ the packed file is abandoned if anything goes wrong, the documents of that run are
+            then ignored, until the next start document
+        """
+        if self._run is None and name!="start":
+            return
+        try:
+            func(*args)
+        except Exception as e:
+            print(f"live packing failed on {name} document: {e}")
+            if self._run is not None:
+                self._abandon()
+    
+    def start(self, doc):
+        if self._run is not None:
+            print(f"{self._run['fn']} was not complete when the next run started")
+            self._abandon()
+        name = doc['sample_name'] if 'sample_name' in doc.keys() else doc['uid']
+        fn = os.path.join(self.dest_dir, f"{name}.h5")
+        tmp_fn = os.path.join(self.dest_dir, f".{name}.h5.live")
+        reg = self.handler_registry
+        if callable(reg):
+            reg = reg(doc)
+        self._run = {"fn": fn, "tmp_fn": tmp_fn, "file": h5py.File(tmp_fn, "w"), "registry": reg, 
+                     "descriptors": {}, "resources": {}, "datums": {}, "handlers": {}, 
+                     "pending": [], "flushed": time.time()}
+        self._run['group'] = self._run['file'].create_group(name)
+        _safe_attrs_assignment(self._run['group'], {"start": doc})
+        print(f"live packing {doc['uid']} into {fn} ...")
+    
+    def descriptor(self, doc):
+        doc = dict(doc)
+        doc.pop('_name', None)
+        desc_group = self._run['group'].create_group(doc['name'])
+        _safe_attrs_assignment(desc_group, doc)
+        data_group = desc_group.create_group('data')
+        keys = [k for k in doc['data_keys'].keys() if self.fields is None or k in self.fields]
+        self._run['descriptors'][doc['uid']] = {
+            "group": desc_group, "data": data_group, "data_keys": doc['data_keys'], "keys": keys, 
+            "time": [], "timestamps": {k: [] for k in keys}, 
+            "columns": {k: [] for k in keys if not doc['data_keys'][k].get('external')},
+            "images": {}, "h5_resources": {}}
+    
+    def resource(self, doc):
+        self._run['resources'][doc['uid']] = doc
+    
+    def datum(self, doc):
+        self._run['datums'][doc['datum_id']] = doc
+    
+    def event(self, doc):
+        run = self._run
+        desc = run['descriptors'][doc['descriptor']]
+        desc['time'].append(doc['time'])
+        for k in desc['keys']:
+            desc['timestamps'][k].append(doc['timestamps'][k])
+            if k in desc['columns'].keys():
+                desc['columns'][k].append(doc['data'][k])
+                continue
+            datum_id = doc['data'][k]
+            res_uid = run['datums'][datum_id]['resource']
+            if run['resources'][res_uid]['spec']=="AD_HDF5":
+                if res_uid not in desc['h5_resources'].setdefault(k, []):
+                    desc['h5_resources'][k].append(res_uid)
+            else:
+                run['pending'].append((time.time(), desc, k, datum_id))
+        self._read_pending()
+        if time.time()-run['flushed']>self.flush_period:
+            run['file'].flush()
+            run['flushed'] = time.time()
+    
+    def _handler(self, res):
+        run = self._run
+        if res['uid'] not in run['handlers'].keys():
+            fpath = os.path.join(res.get('root', ''), update_res_path(res['resource_path'], self.replace_res_path))
+            handler = run['registry'][res['spec']](fpath, **res['resource_kwargs'])
+            if hasattr(handler, "live"):
+                handler.live = True
+            run['handlers'][res['uid']] = handler
+        return run['handlers'][res['uid']]
+    
+    def _read_pending(self, wait=False):
+        """ read the frames of the events received more than read_delay seconds ago, in order,
+            and append them to the datasets; with wait, read all of them
+        """
+        run = self._run
+        while len(run['pending'])>0:
+            t,desc,k,datum_id = run['pending'][0]
+            dt = t+self.read_delay-time.time()
+            if dt>0:
+                if not wait:
+                    break
+                time.sleep(dt)
+            datum = run['datums'][datum_id]
+            frame = self._handler(run['resources'][datum['resource']])(**datum['datum_kwargs'])
+            blk = _frame_block(frame)
+            if k not in desc['images'].keys():
+                chunks = (1, *blk.shape[1:]) if blk.ndim>2 else blk.shape
+                dataset = self.codecs.create_dataset(
+                    desc['data'], k, H5CodecPolicy.field_class(frame), shape=(0, *blk.shape[1:]),
+                    maxshape=(None, *blk.shape[1:]), dtype=blk.dtype, chunks=chunks)
+                _safe_attrs_assignment(dataset, dict(desc['data_keys'][k]))
+                desc['images'][k] = dataset
+            dataset = desc['images'][k]
+            n = dataset.shape[0]
+            dataset.resize(n+len(blk), axis=0)
+            dataset[n:] = blk
+            run['pending'].pop(0)
+    
+    def _copy_h5_resources(self, desc, key):
+        fns = [res['root']+update_res_path(res['resource_path'], self.replace_res_path)
+               for res in [self._run['resources'][ru] for ru in desc['h5_resources'][key]]]
+        t0 = time.time()
+        for fn in fns:
+            while True:   # the file is locked until the IOC closes it
+                try:
+                    h5py.File(fn, "r").close()
+                    break
+                except OSError:
+                    if time.time()-t0>self.file_timeout:
+                        raise Exception(f"timed out waiting for {fn}")
+                    time.sleep(0.5)
+        if len(fns)==1:
+            with h5py.File(fns[0], "r") as hf5:
+                desc['data'].copy(hf5["/entry/data/data"], key)
+            return desc['data'][key]
+        return copy_h5_resources(fns, desc['data'], key)[0]
+    
+    def stop(self, doc):
+        if doc.get('exit_status', 'success')!="success":
+            print(f"run {doc['run_start']} ended with {doc['exit_status']}, the file is not kept")
+            self._abandon()
+            return
+        run = self._run
+        self._read_pending(wait=True)
+        for desc in run['descriptors'].values():
+            self.codecs.create_dataset(desc['group'], 'time', "scalars", data=desc['time'])
+            if self.timestamps:
+                ts_group = desc['group'].create_group('timestamps')
+            for k in desc['keys']:
+                if len(desc['time'])==0:
+                    break
+                if self.timestamps:
+                    self.codecs.create_dataset(ts_group, k, "scalars", data=desc['timestamps'][k])
+                value = desc['data_keys'][k]
+                if k in desc['columns'].keys():
+                    dataset = _create_column_dataset(desc['data'], k, value, desc['columns'][k], self.codecs)
+                elif k in desc['h5_resources'].keys():
+                    dataset = self._copy_h5_resources(desc, k)
+                else:
+                    continue
+                _safe_attrs_assignment(dataset, dict(value))
+        _safe_attrs_assignment(run['group'], {"stop": doc})
+        run['group'].attrs['stop_checksum'] = _stop_checksum(doc)
+        run['file'].close()
+        os.replace(run['tmp_fn'], run['fn'])
+        self._run = None
+        self.completed.append(run['fn'])
+        print(f"live packing complete: {run['fn']}")
+        if self.on_complete is not None:
+            self.on_complete(run['fn'])
+
+
+def benchmark_h5_codecs(codecs=["gzip", "gzip-1", "lzf", "bslz4", "bszstd", "zstd"], 
+                       nframes=20, frames=None, path="/tmp", fletcher32=False):
+    """ write/read time and file size for the codecs, using Pilatus frame shapes
+        frames: a dictionary of image stacks, e.g. {"SAXS": d["SAXS"]} from a packed file 
+            if not given, Poisson noise around a power-law decay from the beam center is used
+        codecs that are not available (e.g. without hdf5plugin) are skipped
+    """
+    if frames is None:
+        frames = {}
+        for det,shape in PilatusCBFHandler.std_image_size.items():
+            y,x = np.indices(shape)
+            r = np.hypot(x-shape[1]/2, y-shape[0]/3)+10
+            frames[det] = np.random.poisson(1e5/r**1.5, size=(nframes, *shape)).astype(np.int32)
+            frames[det][:, :, 487::494] = -1   # module gaps 
+    
+    results = []
+    print(f"{'det':>6} {'codec':>8} {'MB':>8} {'ratio':>6} {'write MB/s':>10} {'read MB/s':>10}")
+    for det,data in frames.items():
+        for codec in codecs:
+            try:
+                kw = H5CodecPolicy(images=codec, fletcher32=fletcher32).kwargs("images")
+            except Exception as e:
+                print(f"skipping {codec}: {e}")
+                continue
+            fn = f"{path}/codec_benchmark_{os.getpid()}.h5"
+            t0 = time.time()
+            with h5py.File(fn, "w") as f:
+                f.create_dataset("data", data=data, chunks=(1, *data.shape[1:]), **kw)
+            t1 = time.time()
+            with h5py.File(fn, "r") as f:
+                f["data"][()]
+            t2 = time.time()
+            size = os.path.getsize(fn)
+            os.remove(fn)
+            ret = {"det": det, "shape": data.shape[1:], "codec": codec, "size": size, 
+                   "ratio": data.nbytes/size, "write": t1-t0, "read": t2-t1}
+            results.append(ret)
+            print(f"{det:>6} {codec:>8} {size/1e6:8.1f} {ret['ratio']:6.2f} "
+                  f"{data.nbytes/1e6/ret['write']:10.1f} {data.nbytes/1e6/ret['read']:10.1f}")
+    return results
+        
+
+def _stop_checksum(stop):
+    """ identifies the stop document of a run, as saved in the group attrs 
+    """
+    return hashlib.sha1(json.dumps(_clean_dict(stop), sort_keys=True).encode()).hexdigest()
+
+def _h5_run_matches(group, uid, checksum):
+    """ whether the group was exported from the run with this uid and stop document checksum
+    """
+    try:
+        start = json.loads(group.attrs['start'])
+        if 'stop_checksum' in group.attrs.keys():
+            stop_checksum = group.attrs['stop_checksum']
+        else:
+            stop_checksum = _stop_checksum(json.loads(group.attrs['stop']))
+    except (KeyError, ValueError, TypeError):
+        return False
+    return start['uid']==uid and stop_checksum==checksum
 
 def _clean_dict(d):
     d = dict(d)
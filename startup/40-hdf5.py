@@ -1,10 +1,11 @@
 #from suitcase import hdf5  #,nexus # available in suitcase 0.6
 
-import h5py,json,os
+import h5py,json,os,shutil,tempfile
 import threading
 import numpy as np
 import epics,socket
 from collections import deque
+import collections
 
 #global default_data_path_root
 #global substitute_data_path_root
@@ -33,32 +34,187 @@ def h5_fix_sample_name(fn_h5):
             f.move(g, sn)
     f.close()
 
-# maximum process allowed to be packing hdf5 files (may use a lot of memory)
-max_packing_processes = 3
-pack_h5_lock = threading.Semaphore(max_packing_processes)
+def h5_materialize(fn_h5, fn_out=None, replace_res_path={}):
+    """ replace the virtual datasets in a file packed with mode="virtual" by copies of the data, 
+        so that the file no longer depends on the resource files
+        the file is updated in place unless fn_out is specified
+        replace_res_path is applied to the resource file names, in case they have been moved since
+    """
+    if fn_out is None:
+        fn_out = fn_h5
+    fn_tmp = fn_out+".materializing"
+    shutil.copyfile(fn_h5, fn_tmp)
+    
+    f = h5py.File(fn_tmp, "r+")
+    vds = []
+    f.visititems(lambda name,obj: vds.append(name) if isinstance(obj, h5py.Dataset) and obj.is_virtual else None)
+    for name in vds:
+        print(f"materializing {name} ...")
+        dset = f[name]
+        attrs = dict(dset.attrs)
+        fns = [update_res_path(vs.file_name, replace_res_path) for vs in dset.virtual_sources()]
+        src_path = dset.virtual_sources()[0].dset_name
+        grp = dset.parent
+        key = name.split('/')[-1]
+        del f[name]
+        if len(fns)==1:
+            with h5py.File(fns[0], "r") as hf5:
+                grp.copy(hf5[src_path], key)
+        else:
+            copy_h5_resources(fns, grp, key, data_path=src_path)
+        for k,v in attrs.items():
+            grp[key].attrs[k] = v
+    f.close()
+    
+    os.replace(fn_tmp, fn_out)
+    return fn_out
+
+def estimate_pack_memory(uids, *args, fields=None, streaming=True, workers=0, **kwargs):
+    """ rough estimate of the peak memory (in bytes) used by pack_h5(), from the data shapes in 
+        the descriptors and the number of events
+        without streaming, 3 copies of each filled (image) field may be in memory at the same time
+        with streaming, only a few frames per field (or per worker) are, plus the frames that 
+        the handler reads ahead (PilatusCBFHandler.read_ahead_frames, at least one point)
+    """
+    if isinstance(uids, str):
+        uids = [uids]
+    if fields is None:
+        fields = pack_h5_default_fields
+    mem = 200e6     # python/databroker overhead
+    for uid in uids:
+        h = db[uid]
+        num_events = h.stop.get('num_events', {})
+        for desc in h.descriptors:
+            nev = num_events.get(desc['name'], 1)
+            frame_mem = 0
+            for k,dk in desc['data_keys'].items():
+                if k not in fields:
+                    continue
+                shape = dk.get('shape') or [1]
+                nb = 4*int(np.prod(shape))
+                if 'external' in dk.keys():
+                    # a point may have several frames
+                    read_ahead = max(nb, 4*int(np.prod(shape[-2:]))*PilatusCBFHandler.read_ahead_frames)
+                    frame_mem = max(frame_mem, 3*nb+read_ahead)
+                    if not streaming:
+                        mem += 3*nb*nev
+                else:
+                    mem += 8*nb*nev    # event list, columns and the array written
+            if streaming:
+                mem += frame_mem*max(1, workers)
+    return mem
+    
+# relative priority of the packing jobs, by data type; higher runs first
+# HPLC users usually wait at the beamline for the processed data, mail-in holders do not
+packing_priorities = {"HPLC": 10, "flyscan": 5, "scan": 5, "mscan": 3, "mfscan": 3, "multi": 2, "sol": 1}
+
+class PackingMemoryScheduler:
+    """ admit pack_h5 jobs against a memory budget (in bytes), instead of a fixed number of slots
+        the jobs are admitted by priority, then in the order they arrive; a job that is larger than 
+        the budget is admitted when nothing else is running
+        by default, the budget is half of the physical memory
+    """
+    def __init__(self, budget=None):
+        if budget is None:
+            budget = os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')/2
+        self.budget = budget
+        self._cv = threading.Condition()
+        self._admitted = {}
+        self._queue = []
+        self._njobs = 0
+    
+    def _used(self):
+        return sum([cost for name,cost in self._admitted.values()])
+    
+    def acquire(self, cost, name="", priority=0):
+        """ block until the job can run, returns a job id for release()
+        """
+        with self._cv:
+            self._njobs += 1
+            job = self._njobs
+            self._queue.append((-priority, job))
+            while not (min(self._queue)[1]==job and 
+                       (len(self._admitted)==0 or self._used()+cost<=self.budget)):
+                self._cv.wait()
+            self._queue.remove((-priority, job))
+            self._admitted[job] = (name, cost)
+            self._cv.notify_all()
+        return job
+        
+    def release(self, job):
+        with self._cv:
+            self._admitted.pop(job)
+            self._cv.notify_all()
+    
+    def status(self):
+        with self._cv:
+            return {"budget": self.budget, "used": self._used(), 
+                    "admitted": list(self._admitted.values()), "queued": len(self._queue)}
+    
+    def print_status(self):
+        st = self.status()
+        print(f"{len(st['admitted'])} packing jobs running, using {st['used']/1e9:.1f} of "
+              f"{st['budget']/1e9:.1f} GB, {st['queued']} waiting.")
+        for name,cost in st['admitted']:
+            print(f"   {name}: {cost/1e9:.2f} GB")
+
+# packing hdf5 files may use a lot of memory, admit pack_h5 jobs based on their estimated size
+pack_h5_scheduler = PackingMemoryScheduler()
 
-def pack_h5_with_lock(*args, **kwargs):
-    pack_h5_lock.acquire()
+def pack_h5_with_lock(*args, priority=0, **kwargs):
+    try:
+        cost = estimate_pack_memory(*args, **kwargs)
+    except Exception as e:
+        print(f"could not estimate the memory needed for packing: {e}")
+        cost = pack_h5_scheduler.budget
+    job = pack_h5_scheduler.acquire(cost, name=str(args[0])[:40], priority=priority)
     try:
         ret = pack_h5(*args, **kwargs)
     except Exception as e:
         print(f"An error occured when packing h5: {e}")
         ret = None
-    pack_h5_lock.release()    
+    pack_h5_scheduler.release(job)
     return ret
+
+pack_h5_default_fields = ['em2_current1_mean_value', 'em2_current2_mean_value',
+                          'em1_sum_all_mean_value', 'em2_sum_all_mean_value', 'em2_ts_SumAll', 'em1_ts_SumAll',
+                          'xsp3_spectrum_array_data', "pilatus_trigger_time",
+                          'pil1M_image', 'pilW1_image', 'pilW2_image', 
+                          'pil1M_ext_image', 'pilW1_ext_image', 'pilW2_ext_image']
     
 def pack_h5(uids, dest_dir='', fn=None, fix_sample_name=True, stream_name=None, 
-            attach_uv_file=False, delete_old_file=True, include_motor_pos=True,
-            fields=['em2_current1_mean_value', 'em2_current2_mean_value',
-                    'em1_sum_all_mean_value', 'em2_sum_all_mean_value', 'em2_ts_SumAll', 'em1_ts_SumAll',
-                    'xsp3_spectrum_array_data', "pilatus_trigger_time",
-                    'pil1M_image', 'pilW1_image', 'pilW2_image', 
-                    'pil1M_ext_image', 'pilW1_ext_image', 'pilW2_ext_image'], replace_res_path={}):
+            attach_uv_file=False, delete_old_file=True, include_motor_pos=True, append=False,
+            fields=pack_h5_default_fields, replace_res_path={},
+            streaming=True, mode="copy", codecs=None, workers=0, worker_memory=None, handler_registry=None,
+            files_ready=None, reducer=None):
     """ if only 1 uid is given, use the sample name as the file name
         any metadata associated with each uid will be retained (e.g. sample vs buffer)
         
         to avoid multiple processed requesting packaging, only 1 process is allowed at a given time
         this is i
+        
+        with streaming=True, images that are not in AD_HDF5 resources are written frame by frame, 
+        the memory usage then no longer scales with the number of frames
+        
+        with mode="virtual", images in AD_HDF5 resources are linked as virtual datasets instead 
+        of copied, use h5_materialize() before the data leave GPFS
+        
+        codecs is a H5CodecPolicy that specifies the compression for images, spectra and scalars
+        
+        with append=True, the existing file is updated: runs already in the file (same uid and 
+        stop document) are not copied again, new or changed runs are added/replaced
+        with fix_sample_name=True, the groups are named after the sample names when written
+        
+        workers>0 exports the image fields (e.g. SAXS and WAXS) in parallel worker processes, 
+        worker_memory (in bytes) limits the memory these can use
+        
+        handler_registry, e.g. from cbf_handler_registry(), is used to read the detector data 
+        instead of the handlers registered with databroker
+        
+        files_ready, if given, is called with the uid before the data for each uid are exported, and 
+        should return once the data files are in place, e.g. RamdiskMover.wait
+        
+        reducer (e.g. H5Reducer) processes the detector images as they are packed
     """
     if isinstance(uids, list):
         if fn is None:
@@ -96,18 +252,22 @@ def pack_h5(uids, dest_dir='', fn=None, fix_sample_name=True, stream_name=None,
             raise Exception(f'{dest_dir} does not exist.')
         fn = dest_dir+'/'+fn
         
-    if delete_old_file:
+    if delete_old_file and not append:
         try:
             os.remove(fn)
         except OSError:
             pass
         
     print(fds)
-    hdf5_export(headers, fn, fields=fds, stream_name=stream_name, use_uid=False, replace_res_path=replace_res_path) #, mds= db.mds, use_uid=False) 
-    
-    # by default the groups in the hdf5 file are named after the scan IDs
-    if fix_sample_name:
-        h5_fix_sample_name(fn)
+    # the groups in the hdf5 file are named after the scan IDs, or the sample names if fix_sample_name
+    if files_ready is not None:
+        # the headers are exported one at a time, in the same order
+        headers = _files_ready(headers, files_ready)
+    hdf5_export(headers, fn, fields=fds, stream_name=stream_name, use_uid=False, 
+                replace_res_path=replace_res_path, streaming=streaming, mode=mode, 
+                codecs=codecs, sample_name_as_group=fix_sample_name, 
+                append=append, workers=workers, worker_memory=worker_memory, 
+                handler_registry=handler_registry, reducer=reducer) #, mds= db.mds, use_uid=False) 
         
     if attach_uv_file:
         # by default the UV file should be saved in /nsls2/xf16id1/Windows/
@@ -118,6 +278,11 @@ def pack_h5(uids, dest_dir='', fn=None, fix_sample_name=True, stream_name=None,
     return fn
 
 
+def _files_ready(headers, files_ready):
+    for h in headers:
+        files_ready(h.start['uid'])
+        yield h
+
 def h5_attach_hplc(fn_h5, fn_hplc, chapter_num=-1, grp_name=None):
     """ the hdf5 is assumed to contain a structure like this:
         LIX_104
@@ -171,9 +336,62 @@ from lixtools.hdf import h5sol_HPLC,h5sol_HT
 from lixtools.atsas import gen_report
 import json
 
+class H5ExpCache:
+    """ the h5exp objects read from exp.h5 files, shared by the packing jobs in this process
+        reading exp.h5 recreates the detectors, including the pixel->q maps (exp_para.Q etc.) that 
+        the azimuthal averaging uses; this is done again only when the file changes (path, mtime 
+        and size), or after invalidate()
+        the least recently used entries are dropped beyond maxsize
+    """
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, fn):
+        fn = os.path.abspath(fn)
+        st = os.stat(fn)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if fn in self._cache.keys() and self._cache[fn][0]==stamp:
+                self._cache.move_to_end(fn)
+                self.hits += 1
+                return self._cache[fn][1]
+        dexp = h5exp(fn)
+        with self._lock:
+            self.misses += 1
+            self._cache[fn] = (stamp, dexp)
+            self._cache.move_to_end(fn)
+            while len(self._cache)>self.maxsize:
+                self._cache.popitem(last=False)
+        return dexp
+    
+    def invalidate(self, fn=None):
+        """ drop fn from the cache, or everything if fn is None
+        """
+        with self._lock:
+            if fn is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(os.path.abspath(fn), None)
+
+h5exp_cache = H5ExpCache()
+
 import socket
 packing_queue_sock_port = 9999
 
+def _packing_uids(data_type, uid):
+    """ the list of uids in the packing request
+    """
+    if data_type not in ["multi", "sol", "mscan", "mfscan"]:
+        return [uid]
+    uids = uid.split('|')
+    if data_type=="sol":  # the last one is the sample-buffer dictionary
+        uids.pop()
+    return uids
+
 # process locally
 def send_to_packing_queue(uid, data_type, froot=data_file_path.gpfs, move_first=False):
     """ data_type must be one of ["scan", "flyscan", "HPLC", "sol", "multi", "mscan"]
@@ -196,195 +414,288 @@ def send_to_packing_queue(uid, data_type, froot=data_file_path.gpfs, move_first=
             print(f"scan {uid} was not successful.")
             return 
 
-    PilatusCBFHandler.froot = data_file_path[froot.name]
-    threading.Thread(target=pack_and_move, args=(data_type,uid,proc_path,move_first,)).start() 
+    if froot==data_file_path.ramdisk and move_first:
+        # the files can be moved early if the RAMDISK is filling up
+        ramdisk_monitor.add_uids(_packing_uids(data_type, uid))
+    threading.Thread(target=pack_and_move, args=(data_type,uid,proc_path,move_first,), 
+                     kwargs={"froot": data_file_path[froot.name]}).start() 
     print("processing thread started ...")                    
         
 
-def send_to_packing_queue_remote(uid, datatype, froot=data_file_path.gpfs, move_first=False):
-    """ data_type must be one of ["scan", "flyscan", "HPLC", "sol", "multi", "mscan"]
-        single uid only for "scan", "flyscan", "HPLC"
-        uids must be concatenated using '|' for "multi" and "sol"
-        if move_first is True, move the files from RAMDISK to GPFS first, otherwise the RAMDISK
-            may fill up since only one pack_h5 process is allow
+# data_path in the start document is on GPFS, the files are first saved at the same path under the RAMDISK
+ramdisk_path_map = (data_file_path.gpfs.value, '/ramdisk')
+
+def _ramdisk_source(uid, dir_name=None):
+    """ the RAMDISK path, GPFS path and the name of the files for the uid, see TransferManager.move()
+        the files are either in a directory (dir_name, the subdir in the start document, or the 
+        sample name), or named after the sample
     """
-    if datatype not in ["scan", "flyscan", "HPLC", "multi", "sol", "mscan", "mfscan"]:
-        raise Exception("invalid data type: {datatype}, valid options are scan and HPLC.")
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
-    s.connect(('xf16id-srv1', packing_queue_sock_port))
-    msg = f"{datatype}::{uid}::{proc_path}::{froot.name}::{move_first}"
-    s.send(msg.encode('ascii'))
-    s.close()
+    h = db[uid]        
+    p1 = h.start['data_path']  
+    #p2 = p1.replace(default_data_path_root, '/ramdisk/')
+    p2 = p1.replace(*ramdisk_path_map)
+    if dir_name is not None:
+        name = dir_name
+    elif "subdir" in h.start.keys():
+        name = h.start['subdir'].rstrip('/')
+    else:
+        # if sample name is a directory on the RAMDISK, move the entire directory
+        name = h.start['sample_name']
+    return p2,p1,name
 
+def ramdisk_claim_keys(uids, dir_name=None):
+    """ what is claimed before the files for uids are moved, see RamdiskClaims: the directory 
+        or sample name on the RAMDISK that the files are moved by
+    """
+    keys = []
+    for uid in uids:
+        p2,p1,name = _ramdisk_source(uid, dir_name)
+        keys.append(os.path.join(p2, name))
+    return sorted(set(keys))
 
-def move_files_from_RAMDISK(uids, dir_name=None):
+def move_files_from_RAMDISK(uids, dir_name=None, progress=None, transfer=None):
+    """ move the data files for all uids from RAMDISK to GPFS, in one transfer 
+        progress, if given, is called as progress(bytes_done, bytes_total)
+        transfer: a TransferManager, ramdisk_transfer by default
+    """
+    if transfer is None:
+        transfer = ramdisk_transfer
+    names = {}
     for uid in uids:
-        print(f'moving files for {uid} from RAMDISK to GPFS ...')
-        h = db[uid]        
-        p1 = h.start['data_path']  
-        #p2 = p1.replace(default_data_path_root, '/ramdisk/')
-        p2 = p1.replace(data_file_path.gpfs.value, '/ramdisk')
-        sample_name = h.start['sample_name']
-        if dir_name is not None:
-            cmd = f"rsync -ahv --remove-source-files det@10.16.0.14:{p2}{dir_name} {p1}"
-        elif "subdir" in h.start.keys():
-            subdir = h.start['subdir']
-            cmd = f"rsync -ahv --remove-source-files det@10.16.0.14:{p2}{subdir} {p1}{subdir}"
-        elif os.system(f"ssh -q det@10.16.0.14 [[ -d {p2}{sample_name} ]]")==0:
-            # if sample name is a directory on the RAMDISK, move the entire directory
-            cmd = f"rsync -ahv --remove-source-files det@10.16.0.14:{p2}{sample_name} {p1}"
-        else:        
-            cmd = f"rsync -ahv --remove-source-files det@10.16.0.14:{p2}{sample_name}_*.* {p1}"
-            #os.system(f"rsync -ahv --remove-source-files det@10.16.0.14:{p2}{h.start['sample_name']}_*.log {p1}")          
-        print(cmd)
-        os.system(cmd)
-
-
-def pack_and_move(data_type, uid, dest_dir, move_first=True):
+        p2,p1,name = _ramdisk_source(uid, dir_name)
+        names.setdefault((p2, p1), [])
+        if name not in names[(p2, p1)]:
+            names[(p2, p1)].append(name)
+    
+    stats = []
+    for (p2,p1),nms in names.items():
+        print(f'moving files for {nms} from RAMDISK to GPFS ...')
+        stats.append(transfer.move(p2, p1, nms, progress=progress))
+    return stats
+
+class RamdiskMover:
+    """ move the files for each uid in turn in a background thread, so that the data for a uid can be 
+        packed as soon as they are on GPFS, while the files for the next uid are still being moved
+        wait(uid) blocks until the files for uid have been moved, see pack_h5(files_ready=...)
+        the files of a sample in a directory shared by several uids (e.g. the holder) are named 
+        after the sample; whatever is left in the directory is moved after the last uid 
+        the files are claimed first (see RamdiskClaims), waiting for any early move to finish
+    """
+    def __init__(self, uids, dir_name=None, progress=None, transfer=None):
+        self.uids = list(uids)
+        self.dir_name = dir_name
+        self.progress = progress
+        self.transfer = ramdisk_transfer if transfer is None else transfer
+        self._moved = {uid: threading.Event() for uid in self.uids}
+        self._failed = {}
+        self._bytes = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def _report(self, done, total):
+        if self.progress is not None:
+            self.progress(self._bytes+done, self._bytes+total)
+        
+    def _run(self):
+        try:
+            keys = ramdisk_claim_keys(self.uids, self.dir_name)
+            ramdisk_claims.acquire(keys)
+        except Exception as e:
+            for uid in self.uids:
+                self._failed[uid] = f"could not claim the files: {e}"
+                self._moved[uid].set()
+            return
+        try:
+            self._move()
+        finally:
+            ramdisk_claims.release(keys)
+    
+    def _move(self):
+        shared = []
+        for uid in self.uids:
+            try:
+                p2,p1,name = _ramdisk_source(uid, self.dir_name)
+                if self.dir_name is not None or "subdir" in db[uid].start.keys():
+                    shared.append(uid)
+                    name = os.path.join(name, db[uid].start['sample_name'])
+                st = self.transfer.move(p2, p1, [name], progress=self._report)
+                self._bytes += st['bytes']
+                if len(st['failed'])>0:
+                    self._failed[uid] = f"{len(st['failed'])} files could not be moved"
+            except Exception as e:
+                self._failed[uid] = f"{type(e).__name__}: {e}"
+            self._moved[uid].set()
+        if len(shared)>0:
+            try:
+                move_files_from_RAMDISK(shared, self.dir_name, transfer=self.transfer)
+            except Exception as e:
+                print(f"could not move the remaining files: {e}")
+    
+    def wait(self, uid):
+        self._moved[uid].wait()
+        if uid in self._failed.keys():
+            raise Exception(f"files for {uid} were not moved: {self._failed[uid]}")
+    
+    def join(self):
+        self._thread.join()
+        return self._failed
+
+
+def pack_and_move(data_type, uid, dest_dir, move_first=True, progress=None, froot=None, pipeline=False,
+                  reduce=False):
     # useful for moving files from RAM disk to GPFS during fly scans
     # 
     # assume other type of data are saved on RAM disk as well (GPFS not working for WAXS2)
     # these data must be moved manually to GPFS
     #global pilatus_trigger_mode  #,CBF_replace_data_path 
+    # progress, if given, is called with the name of each stage: "moving", "packing", "processing", 
+    # and with a message on the progress of moving the files
+    # froot is where the CBF files are, PilatusCBFHandler.froot if not given
+    # the handler settings are passed to pack_h5() for this job only, and the file is packed into a 
+    # temporary file first, so that several jobs can run at the same time
+    # with move_first and pipeline=True, the data for each uid are packed as soon as they are moved
+    # with reduce=True, the images for "sol", "multi" and "mfscan" are also reduced to 1D while they 
+    # are packed (H5Reducer), so that the 1D data are in the file as soon as it is packed; the 
+    # processing that follows still starts from the images, and replaces them
+    # returns the name of the packed file, None if packing failed
+    if progress is None:
+        progress = lambda stage, msg=None: None
+    if froot is None:
+        froot = PilatusCBFHandler.froot
     
     print(f"packing: {data_type}, {uid}, {dest_dir}")
-    print(f"data source: {PilatusCBFHandler.froot}")
+    print(f"data source: {froot}")
     t0 = time.time()
     # if the dest_dir contains exp.h5, read detectors/qgrid from it
     try:
-        dt_exp = h5exp(dest_dir+'/exp.h5')
+        dt_exp = h5exp_cache.get(dest_dir+'/exp.h5')
     except:
         dt_exp = None
 
     dir_name = None
-    original_file_path = PilatusCBFHandler.froot
+    mover = None
+    move_progress = lambda done,total: progress("moving", f"{done/1e6:.0f}/{total/1e6:.0f} MB")
     
-    if PilatusCBFHandler.froot==data_file_path.ramdisk and move_first:
-        print("move files to GPFS first ...")
-        if isinstance(uid, str):
-            uids = [uid]
-        else:
-            uids = uid
+    if froot==data_file_path.ramdisk and move_first:
+        uids = _packing_uids(data_type, uid)
+        ramdisk_monitor.remove_uids(uids)
         hdr = db[uids[0]].start
         if 'holderName' in list(hdr.keys()):
             dir_name = hdr['holderName']
-        move_files_from_RAMDISK(uids, dir_name)
-        PilatusCBFHandler.froot=data_file_path.gpfs
+        if pipeline:
+            print("moving files to GPFS while packing ...")
+            mover = RamdiskMover(uids, dir_name, 
+                                 progress=lambda done,total: progress("packing", f"moved {done/1e6:.0f}/{total/1e6:.0f} MB"))
+        else:
+            print("move files to GPFS first ...")
+            progress("moving")
+            keys = ramdisk_claim_keys(uids, dir_name)
+            ramdisk_claims.acquire(keys)   # wait if RamdiskMonitor is moving them early
+            try:
+                move_files_from_RAMDISK(uids, dir_name, progress=move_progress)
+            finally:
+                ramdisk_claims.release(keys)
+        froot = data_file_path.gpfs
+    files_ready = None if mover is None else mover.wait
     
     if data_type in ["multi", "sol", "mscan", "mfscan"]:
         uids = uid.split('|')
         if data_type=="sol":
             sb_dict = json.loads(uids.pop())
-            PilatusCBFHandler.trigger_mode = triggerMode.fly_scan
+            trigger_mode = triggerMode.fly_scan
         elif data_type=="mfscan":
-            PilatusCBFHandler.trigger_mode = triggerMode.fly_scan
+            trigger_mode = triggerMode.fly_scan
         else:
-            PilatusCBFHandler.trigger_mode = triggerMode.external_trigger
+            trigger_mode = triggerMode.external_trigger
         ## assume that the meta data contains the holderName
         if 'holderName' not in list(db[uids[0]].start.keys()):
-            print("cannot find holderName from the header, using tmp.h5 as filename ...")
-            fh5_name = "tmp.h5"
+            fh5_name = uids[0]+'.h5'
+            print(f"cannot find holderName from the header, using {fh5_name} as filename ...")
         else:
             dir_name = db[uids[0]].start['holderName']
             fh5_name = dir_name+'.h5'
-        fn = pack_h5_with_lock(uids, dest_dir, fn="tmp.h5")
-        if fn is not None and dt_exp is not None and data_type!="mscan":
-            print('processing ...')
-            if data_type=="sol":    
-                dt = h5sol_HT(fn, [dt_exp.detectors, dt_exp.qgrid])
-                dt.assign_buffer(sb_dict)
-                dt.process(filter_data=True, sc_factor="auto", debug='quiet')
-                #dt.export_d1s(path=dest_dir+"/processed/")
-            elif data_type=="multi":
-                dt = h5xs(fn, [dt_exp.detectors, dt_exp.qgrid], transField='em2_sum_all_mean_value')
-                dt.load_data(debug="quiet")
-            elif data_type=="mfscan":
-                dt = h5xs(fn, [dt_exp.detectors, dt_exp.qgrid])
-                dt.load_data(debug="quiet")
-            dt.fh5.close()
-            del dt,dt_exp            
-            if fh5_name is not "tmp.h5":  # temporary fix, for some reason other processes cannot open the packed file
-                os.system(f"cd {dest_dir} ; cp tmp.h5 {fh5_name} ; rm tmp.h5")
+        fd,fn_tmp = tempfile.mkstemp(prefix=".packing-", suffix=".h5", dir=dest_dir)
+        os.close(fd)
+        reducer = None
+        if reduce and dt_exp is not None and data_type!="mscan":
+            reducer = H5Reducer(dt_exp.detectors, dt_exp.qgrid)
+        progress("packing")
+        fn = pack_h5_with_lock(uids, dest_dir, fn=os.path.basename(fn_tmp), priority=packing_priorities[data_type],
+                               handler_registry=cbf_handler_registry(froot=froot, trigger_mode=trigger_mode),
+                               files_ready=files_ready, reducer=reducer)
+        if fn is None:
+            if os.path.exists(fn_tmp):
+                os.remove(fn_tmp)
+        else:
+            if dt_exp is not None and data_type!="mscan":
+                print('processing ...')
+                progress("processing")
+                if data_type=="sol":    
+                    dt = h5sol_HT(fn, [dt_exp.detectors, dt_exp.qgrid])
+                    dt.assign_buffer(sb_dict)
+                    dt.process(filter_data=True, sc_factor="auto", debug='quiet')
+                    #dt.export_d1s(path=dest_dir+"/processed/")
+                elif data_type=="multi":
+                    dt = h5xs(fn, [dt_exp.detectors, dt_exp.qgrid], transField='em2_sum_all_mean_value')
+                    dt.load_data(debug="quiet")
+                elif data_type=="mfscan":
+                    dt = h5xs(fn, [dt_exp.detectors, dt_exp.qgrid])
+                    dt.load_data(debug="quiet")
+                dt.fh5.close()
+                del dt,dt_exp            
+            fn = os.path.join(dest_dir, fh5_name)
+            os.replace(fn_tmp, fn)
             try:
-                gen_report(fh5_name)
+                gen_report(fn)
             except:
                 pass
     elif data_type=="HPLC":
         uids = [uid]
         if db[uid].start['plan_name']=="hplc_scan":
             # this was software_trigger_single_frame when using the flyer-based hplc_scan
-            PilatusCBFHandler.trigger_mode = triggerMode.software_trigger_single_frame
+            trigger_mode = triggerMode.software_trigger_single_frame
         else:
             # data collected using ct
             # could be ct(num=1) (software multiframe trigger), or ct(num=N) (hardware trigger)
             if db[uid].start['num_points']==1:
-                PilatusCBFHandler.trigger_mode = triggerMode.software_trigger_multi_frame
+                trigger_mode = triggerMode.software_trigger_multi_frame
             else:
-                PilatusCBFHandler.trigger_mode = triggerMode.external_trigger
-        fn = pack_h5_with_lock(uid, dest_dir=dest_dir, attach_uv_file=True)
+                trigger_mode = triggerMode.external_trigger
+        progress("packing")
+        fn = pack_h5_with_lock(uid, dest_dir=dest_dir, attach_uv_file=True, priority=packing_priorities[data_type],
+                               handler_registry=cbf_handler_registry(froot=froot, trigger_mode=trigger_mode),
+                               files_ready=files_ready)
         if fn is not None and dt_exp is not None:
             print('procesing ...')
+            progress("processing")
             dt = h5sol_HPLC(fn, [dt_exp.detectors, dt_exp.qgrid])
             dt.process(debug='quiet')
             dt.fh5.close()
             del dt,dt_exp
     elif data_type=="flyscan" or data_type=="scan":
         if data_type=="flyscan":
-            PilatusCBFHandler.trigger_mode = triggerMode.fly_scan
+            trigger_mode = triggerMode.fly_scan
         else:
-            PilatusCBFHandler.trigger_mode = triggerMode.external_trigger
+            trigger_mode = triggerMode.external_trigger
         uids = [uid]
-        fn = pack_h5_with_lock(uid, dest_dir=dest_dir)
+        progress("packing")
+        fn = pack_h5_with_lock(uid, dest_dir=dest_dir, priority=packing_priorities[data_type],
+                               handler_registry=cbf_handler_registry(froot=froot, trigger_mode=trigger_mode),
+                               files_ready=files_ready)
     else:
         print(f"invalid data type: {data_type} .")
         return
 
+    if mover is not None:
+        # the rest of the files, e.g. logs, may still be moving
+        mover.join()
     if fn is None:
         return # packing unsuccessful, 
     print(f"{time.asctime()}: finished packing/processing, total time lapsed: {time.time()-t0:.1f} sec ...")
 
-    if PilatusCBFHandler.froot==data_file_path.ramdisk and not move_first:
-        move_files_from_RAMDISK(uids)
+    if froot==data_file_path.ramdisk and not move_first:
+        progress("moving")
+        move_files_from_RAMDISK(uids, 
+                                progress=lambda done,total: progress("moving", f"{done/1e6:.0f}/{total/1e6:.0f} MB"))
         
-    original_file_path = PilatusCBFHandler.froot
-
-            
-def process_packing_queue():
-    """ this should only run on xf16idc-gpu1, moved to srv1 Mar 2022
-        needed for HPLC run and microbeam mapping
-    """    
-    serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
-    host = socket.gethostname()                           
-    if host!='xf16id-srv1' and host!="xf16id-srv1.nsls2.bnl.local":
-        raise Exception(f"this function can only run on xf16id-srv1, not {host}.")
-    serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    serversocket.bind(('xf16id-srv1', packing_queue_sock_port))  
-    serversocket.listen(5)
-    print('listening ...')
-    
-    while True:
-        clientsocket,addr = serversocket.accept()      
-        print(f"{time.asctime()}: got a connection from {addr} ...")
-        msg = clientsocket.recv(8192).decode()
-        print(msg)
-        clientsocket.close()
-        data_type,uid,path,frn,t = msg.split("::") 
-        if t is True:
-            move_first = True
-        else:
-            move_first = False
-        
-        if data_type not in ["multi", "sol", "mscan", "mfscan"]: # single UID
-            if 'exit_status' not in db[uid].stop.keys():
-                print(f"in complete header for {uid}.")
-                return
-            if db[uid].stop['exit_status'] != 'success': # the scan actually finished
-                print(f"scan {uid} was not successful.")
-                return 
-        #print(uid)
-        #print(path)
-        PilatusCBFHandler.froot = data_file_path[frn]
-        threading.Thread(target=pack_and_move, args=(data_type,uid,path,move_first,)).start() 
-        print("processing thread started ...")            
-
-
+    return fn
@@ -0,0 +1,499 @@
+import os,sys,time,json,signal,socket,sqlite3,struct,asyncio
+import multiprocessing
+
+# the packing server runs on xf16id-srv1: process_packing_queue()
+# the jobs are kept in a sqlite database, so that they survive a restart of the server
+# a bounded pool of worker processes runs pack_and_move() for the queued jobs
+# clients talk to the server using length-prefixed (4-byte, big-endian) json messages, e.g.
+#    {"verb": "submit", "data_type": "sol", "uid": ..., "path": ..., "froot": "gpfs", "move_first": False}
+#    {"verb": "status", "job": 12}
+#    {"verb": "list", "states": ["queued", "packing"]}
+#    {"verb": "cancel", "job": 12}
+#    {"verb": "metrics", "since": time.time()-86400}
+# the reply is {"ok": True, ...}, or {"ok": False, "error": ...}
+
+packing_job_db = os.path.expanduser("~/.lix_packing_jobs.db")
+packing_server_host = 'xf16id-srv1'
+packing_msg_max_size = 1<<24
+
+# a queued job is scored by weight*(1+wait/packing_aging_time)/(1+number of running jobs for the
+# same proposal), the job with the highest score runs next; see packing_priorities in 40-hdf5.py 
+# the aging keeps low-priority jobs from waiting forever; the division by the running jobs keeps one 
+# mail-in batch from taking all workers while other proposals are waiting
+packing_aging_time = 3600
+class PackingJobStore:
+    """ persistent list of packing jobs
+        state: queued -> moving -> packing -> processing -> done, or failed/cancelled
+        a job that cannot run yet (e.g. the stop document is not there) is queued again,
+        with not_before set for the retry
+        timings: time (sec) spent in each state, in json
+        mem: the estimated memory (bytes) needed for packing, see estimate_memory()
+        the jobs are admitted against mem_budget, shared by all workers, when they are claimed; 
+        the default is the budget of pack_h5_scheduler, half of the physical memory
+        a job is only claimed once it has an estimate
+    """
+    states = ["queued", "moving", "packing", "processing", "done", "failed", "cancelled"]
+    running_states = ["moving", "packing", "processing"]
+    columns = {"id": "INTEGER PRIMARY KEY AUTOINCREMENT", 
+               "data_type": "TEXT", "uid": "TEXT", "path": "TEXT", "froot": "TEXT", "move_first": "INTEGER",
+               "state": "TEXT", "attempts": "INTEGER DEFAULT 0", "not_before": "REAL DEFAULT 0",
+               "submitted": "REAL", "started": "REAL", "finished": "REAL", "message": "TEXT",
+               "state_changed": "REAL", "timings": "TEXT DEFAULT '{}'", "proposal": "TEXT", "mem": "REAL"}
+
+    def __init__(self, fn=packing_job_db, mem_budget=None):
+        self.fn = fn
+        self.mem_budget = pack_h5_scheduler.budget if mem_budget is None else mem_budget
+        with self._connect() as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS jobs ({', '.join([f'{k} {v}' for k,v in self.columns.items()])})")
+            # databases created by an older version may be missing some columns
+            existing = [r['name'] for r in conn.execute("PRAGMA table_info(jobs)").fetchall()]
+            for k,v in self.columns.items():
+                if k not in existing:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {k} {v}")
+
+    def _connect(self):
+        # a new connection every time, the store is shared by several processes
+        conn = sqlite3.connect(self.fn, timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def submit(self, data_type, uid, path, froot, move_first, proposal=None):
+        t = time.time()
+        with self._connect() as conn:
+            cur = conn.execute("""INSERT INTO jobs (data_type, uid, path, froot, move_first, state, submitted, 
+                                                    state_changed, proposal)
+                                  VALUES (?, ?, ?, ?, ?, 'queued', ?, ?, ?)""",
+                               (data_type, uid, path, froot, int(move_first), t, t, str(proposal)))
+            return cur.lastrowid
+
+    def _next_job(self, conn, now, admit=None):
+        """ the queued job that should run next, see packing_aging_time
+            within the same proposal and data type, the jobs run in the order they are submitted
+            with admit, the best job for which admit(row) is True, a job that does not fit does 
+            not hold up the others
+        """
+        running = {}
+        for r in conn.execute(f"""SELECT proposal, COUNT(*) AS n FROM jobs 
+                                  WHERE state IN ({','.join('?'*len(self.running_states))}) GROUP BY proposal""",
+                              self.running_states).fetchall():
+            running[r['proposal']] = r['n']
+        best,score = None,None
+        for row in conn.execute("""SELECT * FROM jobs WHERE id IN (SELECT MIN(id) FROM jobs 
+                                   WHERE state='queued' AND not_before<=? GROUP BY proposal, data_type)""",
+                                (now,)).fetchall():
+            if admit is not None and not admit(row):
+                continue
+            sc = packing_priorities.get(row['data_type'], 1)*(1+(now-row['submitted'])/packing_aging_time)
+            sc /= 1+running.get(row['proposal'], 0)
+            if score is None or sc>score:
+                best,score = row,sc
+        return best
+
+    def _set_state(self, conn, row, state, **kwargs):
+        """ record the time spent in the current state before moving on to the next
+        """
+        t = time.time()
+        timings = json.loads(row['timings'] or '{}')
+        timings[row['state']] = timings.get(row['state'], 0) + t-(row['state_changed'] or t)
+        kwargs.update({"state": state, "state_changed": t, "timings": json.dumps(timings)})
+        if state in ["done", "failed", "cancelled"]:
+            kwargs["finished"] = t
+        conn.execute(f"UPDATE jobs SET {', '.join([k+'=?' for k in kwargs.keys()])} WHERE id=?",
+                     (*kwargs.values(), row['id']))
+
+    def _admission(self, conn):
+        """ admit(row): whether there is enough memory left for the job, given the jobs already 
+            running; a job larger than the budget only runs on its own
+        """
+        running = conn.execute(f"""SELECT mem FROM jobs 
+                                   WHERE state IN ({','.join('?'*len(self.running_states))})""",
+                               self.running_states).fetchall()
+        used = sum([r['mem'] or 0 for r in running])
+        return lambda row: row['mem'] is not None and (len(running)==0 or used+row['mem']<=self.mem_budget)
+
+    def estimate_memory(self, estimate, max_attempts=10, retry_delay=30):
+        """ set mem for the queued jobs that do not have it yet, using estimate(job)
+            this may take a while (databroker), so it is done outside of claim(), once per job
+            estimate(job) returns None if the runs have not finished yet (no stop document), the 
+            job is then kept out of the queue for a while, with the delay doubling every time
+            if the estimate fails, the job is charged the whole budget, i.e. it runs on its own
+        """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id FROM jobs WHERE state='queued' AND mem IS NULL AND not_before<=?", 
+                                (time.time(),)).fetchall()
+        for r in rows:
+            job = self.get(r['id'])
+            try:
+                mem = estimate(job)
+            except Exception as e:
+                print(f"could not estimate the memory needed for job {job['id']}: {e}")
+                mem = self.mem_budget
+            if mem is not None:
+                self.update(job['id'], mem=mem)
+            elif job['attempts']>=max_attempts:
+                self.update(job['id'], state="failed", message="incomplete header")
+            else:
+                delay = retry_delay*2**job['attempts']
+                print(f"incomplete header for job {job['id']}, will try again in {delay} sec ...")
+                self.update(job['id'], attempts=job['attempts']+1, not_before=time.time()+delay,
+                            message="incomplete header")
+
+    def claim(self):
+        """ take the queued job that should run next, among those that fit in the memory left, 
+            returns None if there is none
+            started is the time the job first left the queue, for the wait time
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            row = self._next_job(conn, now, self._admission(conn))
+            if row is not None:
+                self._set_state(conn, row, "packing", started=row['started'] or now, attempts=row['attempts']+1)
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return None if row is None else self.get(row['id'])
+
+    def update(self, job_id, **kwargs):
+        if "state" in kwargs.keys() and kwargs["state"] not in self.states:
+            raise Exception(f"invalid job state: {kwargs['state']}")
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+            if row is None:
+                raise Exception(f"no such job: {job_id}")
+            if "state" in kwargs.keys():
+                self._set_state(conn, row, kwargs.pop("state"), **kwargs)
+            elif len(kwargs)>0:
+                conn.execute(f"UPDATE jobs SET {', '.join([k+'=?' for k in kwargs.keys()])} WHERE id=?",
+                             (*kwargs.values(), job_id))
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def retry(self, job_id, delay, message):
+        self.update(job_id, state="queued", not_before=time.time()+delay, message=message)
+
+    def cancel(self, job_id):
+        """ only jobs that have not started can be cancelled, returns the state of the job
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+            if row is None:
+                raise Exception(f"no such job: {job_id}")
+            state = row['state']
+            if state=="queued":
+                self._set_state(conn, row, "cancelled", message="cancelled by request")
+                state = "cancelled"
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return state
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['timings'] = json.loads(job['timings'] or '{}')
+        return job
+
+    def list(self, states=None):
+        with self._connect() as conn:
+            if states is None:
+                rows = conn.execute("SELECT id FROM jobs ORDER BY id").fetchall()
+            else:
+                rows = conn.execute(f"SELECT id FROM jobs WHERE state IN ({','.join('?'*len(states))}) ORDER BY id",
+                                    states).fetchall()
+        return [self.get(r['id']) for r in rows]
+
+    def metrics(self, since=None):
+        """ queue wait time (sec) for each data type, for jobs submitted after since (time.time())
+        """
+        if since is None:
+            since = 0
+        with self._connect() as conn:
+            rows = conn.execute("SELECT data_type, state, submitted, started FROM jobs WHERE submitted>=?", 
+                                (since,)).fetchall()
+        now = time.time()
+        ret = {}
+        for dt in set([r['data_type'] for r in rows]):
+            waits = sorted([r['started']-r['submitted'] for r in rows if r['data_type']==dt and r['started']])
+            queued = [now-r['submitted'] for r in rows if r['data_type']==dt and r['state']=="queued"]
+            ret[dt] = {"weight": packing_priorities.get(dt, 1), "started": len(waits), 
+                       "mean_wait": sum(waits)/len(waits) if waits else None,
+                       "median_wait": waits[len(waits)//2] if waits else None,
+                       "max_wait": waits[-1] if waits else None,
+                       "queued": len(queued), "oldest_queued": max(queued) if queued else None}
+        return ret
+
+    def requeue_interrupted(self):
+        """ jobs that were running when the server stopped are queued again
+        """
+        jobs = self.list(self.running_states)
+        for job in jobs:
+            self.update(job['id'], state="queued", message="interrupted")
+        if len(jobs)>0:
+            print(f"{len(jobs)} interrupted packing jobs queued again ...")
+
+
+def run_packing_job(store, job, max_attempts=10, retry_delay=30):
+    """ pack_and_move() for the job, with the progress recorded in the store
+        if the run has not finished yet (no stop document), try again later, with the delay
+        doubling every time
+    """
+    job_id = job['id']
+    data_type,uid = job['data_type'],job['uid']
+    try:
+        if data_type not in ["multi", "sol", "mscan", "mfscan"]: # single UID
+            stop = db[uid].stop
+            if stop is None or 'exit_status' not in stop.keys():
+                if job['attempts']>=max_attempts:
+                    store.update(job_id, state="failed", message="incomplete header")
+                else:
+                    delay = retry_delay*2**(job['attempts']-1)
+                    print(f"incomplete header for {uid}, will try again in {delay} sec ...")
+                    store.retry(job_id, delay, "incomplete header")
+                return
+            if stop['exit_status'] != 'success': # the scan actually finished
+                store.update(job_id, state="failed", message=f"scan was not successful: {stop['exit_status']}")
+                return
+
+        fn = pack_and_move(data_type, uid, job['path'], bool(job['move_first']), froot=data_file_path[job['froot']],
+                           progress=lambda stage, msg=None: store.update(job_id, state=stage, message=msg))
+        if fn is None:
+            store.update(job_id, state="failed", message="packing failed")
+        else:
+            store.update(job_id, state="done", message=fn)
+    except Exception as e:
+        store.update(job_id, state="failed", message=f"{type(e).__name__}: {e}")
+
+def _estimate_job_memory(job):
+    """ None if any of the runs has not finished yet
+    """
+    uids = _packing_uids(job['data_type'], job['uid'])
+    for uid in uids:
+        if db[uid].stop is None:
+            return None
+    return estimate_pack_memory(uids)
+
+def _packing_worker(store_fn, max_jobs=10, poll_period=2):
+    """ runs in a worker process, exits after max_jobs to release memory; the server starts a new one
+        the memory is admitted by the store, for all workers; within the worker, the job is the 
+        only one that pack_h5_scheduler sees
+        also exits if the process that started it is gone
+    """
+    store = PackingJobStore(store_fn)
+    ppid = os.getppid()
+    njobs = 0
+    while njobs<max_jobs and os.getppid()==ppid:
+        store.estimate_memory(_estimate_job_memory)
+        job = store.claim()
+        if job is None:
+            time.sleep(poll_period)
+            continue
+        print(f"{time.asctime()}: worker {os.getpid()} running job {job['id']}: {job['data_type']}, {job['uid'][:40]}")
+        run_packing_job(store, job)
+        njobs += 1
+
+
+def _pack_msg(obj):
+    buf = json.dumps(obj).encode()
+    return struct.pack(">I", len(buf))+buf
+
+async def _read_msg(reader):
+    n, = struct.unpack(">I", await reader.readexactly(4))
+    if n>packing_msg_max_size:
+        raise Exception(f"message too long: {n} bytes")
+    return json.loads((await reader.readexactly(n)).decode())
+
+def _handle_packing_request(store, req):
+    """ returns the reply for one request
+    """
+    verb = req.get("verb")
+    if verb=="submit":
+        data_type = req["data_type"]
+        if data_type not in ["scan", "flyscan", "HPLC", "multi", "sol", "mscan", "mfscan"]:
+            raise Exception(f"invalid data type: {data_type}")
+        job_id = store.submit(data_type, req["uid"], req["path"], req.get("froot", "gpfs"), 
+                              bool(req.get("move_first", False)), req.get("proposal"))
+        print(f"{time.asctime()}: queued {data_type} as job {job_id} ...")
+        return {"job": job_id}
+    elif verb=="status":
+        job = store.get(int(req["job"]))
+        if job is None:
+            raise Exception(f"no such job: {req['job']}")
+        return {"job": job}
+    elif verb=="list":
+        return {"jobs": store.list(req.get("states"))}
+    elif verb=="cancel":
+        return {"state": store.cancel(int(req["job"]))}
+    elif verb=="metrics":
+        return {"metrics": store.metrics(req.get("since"))}
+    raise Exception(f"unknown verb: {verb}")
+
+async def _serve_packing_client(store, reader, writer):
+    """ a client may send any number of requests on the same connection
+    """
+    addr = writer.get_extra_info('peername')
+    try:
+        while True:
+            try:
+                req = await _read_msg(reader)
+            except asyncio.IncompleteReadError:
+                break
+            try:
+                # sqlite may wait for a lock held by a worker, keep that out of the event loop
+                reply = await asyncio.get_running_loop().run_in_executor(None, _handle_packing_request, store, req)
+                reply["ok"] = True
+            except Exception as e:
+                print(f"invalid request from {addr}: {e}")
+                reply = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            writer.write(_pack_msg(reply))
+            await writer.drain()
+    except Exception as e:
+        print(f"connection from {addr} closed: {e}")
+    finally:
+        writer.close()
+
+def _keep_packing_workers(store_fn, nworkers, period=5):
+    """ the workers exit after a number of jobs, start new ones to keep nworkers running
+        this runs in its own process, started before the server socket is opened, so that the 
+        workers never inherit the socket; the workers are not daemons, so that pack_h5() can
+        start processes of its own (workers>0)
+        exits, after stopping the workers, when terminated or when the server is gone
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    ctx = multiprocessing.get_context("fork")
+    ppid = os.getppid()
+    workers = []
+    try:
+        while os.getppid()==ppid:
+            workers = [p for p in workers if p.is_alive()]
+            while len(workers)<nworkers:
+                p = ctx.Process(target=_packing_worker, args=(store_fn,))
+                p.start()
+                workers.append(p)
+            time.sleep(period)
+    finally:
+        for p in workers:
+            p.terminate()
+        for p in workers:
+            p.join()
+
+async def _packing_server(nworkers, store_fn):
+    store = PackingJobStore(store_fn)
+    store.requeue_interrupted()
+    # start the workers before the server socket is opened
+    manager = multiprocessing.get_context("fork").Process(target=_keep_packing_workers, args=(store_fn, nworkers))
+    manager.start()
+    try:
+        server = await asyncio.start_server(lambda r,w: _serve_packing_client(store, r, w),
+                                            packing_server_host, packing_queue_sock_port, reuse_address=True)
+        print('listening ...')
+        async with server:
+            await server.serve_forever()
+    finally:
+        manager.terminate()
+        manager.join()
+
+def process_packing_queue(nworkers=3, store_fn=packing_job_db, frame_cache=cbf_frame_cache):
+    """ this should only run on xf16idc-gpu1, moved to srv1 Mar 2022
+        needed for HPLC run and microbeam mapping
+        the workers keep the decoded CBF frames in frame_cache (each has its own memory tier), 
+        so that a sample that is packed again is not decoded again; None to turn this off
+    """
+    host = socket.gethostname()
+    if host!=packing_server_host and host!=f"{packing_server_host}.nsls2.bnl.local":
+        raise Exception(f"this function can only run on {packing_server_host}, not {host}.")
+    PilatusCBFHandler.frame_cache = frame_cache
+    asyncio.run(_packing_server(nworkers, store_fn))
+
+
+def _send_to_packing_server(req, timeout=30):
+    """ send one request to the packing server, returns the reply
+    """
+    with socket.create_connection((packing_server_host, packing_queue_sock_port), timeout=timeout) as s:
+        s.sendall(_pack_msg(req))
+        fp = s.makefile("rb")
+        buf = fp.read(4)
+        if len(buf)<4:
+            raise Exception("no reply from the packing server")
+        n, = struct.unpack(">I", buf)
+        reply = json.loads(fp.read(n).decode())
+    if not reply.pop("ok"):
+        raise Exception(f"packing server: {reply['error']}")
+    return reply
+
+def send_to_packing_queue_remote(uid, datatype, froot=data_file_path.gpfs, move_first=False):
+    """ data_type must be one of ["scan", "flyscan", "HPLC", "sol", "multi", "mscan"]
+        single uid only for "scan", "flyscan", "HPLC"
+        uids must be concatenated using '|' for "multi" and "sol"
+        if move_first is True, move the files from RAMDISK to GPFS first, otherwise the RAMDISK
+            may fill up since only one pack_h5 process is allow
+        the jobs are scheduled by priority (packing_priorities) and by proposal
+        returns the job id, see packing_job_status()
+    """
+    if datatype not in ["scan", "flyscan", "HPLC", "multi", "sol", "mscan", "mfscan"]:
+        raise Exception(f"invalid data type: {datatype}, valid options are scan and HPLC.")
+    if froot==data_file_path.ramdisk and move_first:
+        # the files can be moved early if the RAMDISK is filling up
+        ramdisk_monitor.add_uids(_packing_uids(datatype, uid))
+    return _send_to_packing_server({"verb": "submit", "data_type": datatype, "uid": uid, "path": proc_path, 
+                                    "froot": froot.name, "move_first": move_first, 
+                                    "proposal": proposal_id})["job"]
+
+def packing_job_status(job_id):
+    """ the job as recorded by the packing server, including the state:
+        queued, moving, packing, processing, done, failed or cancelled
+        and the time spent in each state
+    """
+    return _send_to_packing_server({"verb": "status", "job": job_id})["job"]
+
+def list_packing_jobs(states=None):
+    """ e.g. states=["queued", "packing"], all jobs if states is None
+    """
+    return _send_to_packing_server({"verb": "list", "states": states})["jobs"]
+
+def cancel_packing_job(job_id):
+    """ only queued jobs can be cancelled, returns the state of the job
+    """
+    return _send_to_packing_server({"verb": "cancel", "job": job_id})["state"]
+
+def wait_for_packing(job_id, timeout=None, poll_period=10):
+    """ wait for the job to finish (done, failed or cancelled), return the job
+        return None if the job is still not finished after timeout (sec)
+    """
+    t0 = time.time()
+    while True:
+        job = packing_job_status(job_id)
+        if job['state'] in ["done", "failed", "cancelled"]:
+            return job
+        if timeout is not None and time.time()-t0>timeout:
+            return None
+        time.sleep(poll_period)
+
+def packing_queue_metrics(since=None):
+    """ print the queue wait time for each data type, since: time.time() of the earliest submission
+    """
+    metrics = _send_to_packing_server({"verb": "metrics", "since": since})["metrics"]
+    fmt = lambda t: "-" if t is None else f"{t:.0f}"
+    print(f"{'data type':>10} {'weight':>6} {'started':>8} {'mean wait':>10} {'median':>8} {'max':>8} {'queued':>7} {'oldest':>8}")
+    for dt,m in sorted(metrics.items(), key=lambda x: -x[1]['weight']):
+        print(f"{dt:>10} {m['weight']:>6} {m['started']:>8} {fmt(m['mean_wait']):>10} {fmt(m['median_wait']):>8} "
+              f"{fmt(m['max_wait']):>8} {m['queued']:>7} {fmt(m['oldest_queued']):>8}")
+    return metrics
@@ -0,0 +1,286 @@
+import os,json,time,tempfile,shutil,hashlib,resource
+import numpy as np
+import h5py
+
+# benchmark for pack_h5()/pack_and_move(), using a temporary databroker and generated data files
+# no access to MongoDB or to real detector data is needed, e.g.
+#    run_pack_benchmark(scale=0.1)                        # quick check
+#    run_pack_benchmark(save_baseline=True)               # update the baseline
+#    run_pack_benchmark(["holder18"], compare=True)       # check for regressions
+#    run_pipeline_benchmark()                              # move-then-pack vs pipelined, from RAMDISK
+
+pack_benchmark_baseline = os.path.expanduser("~/.lix_pack_benchmark.json")
+
+# name: (plan_name, data_type, spec, number of runs, events per run, resources per run)
+# the HPLC run is packed as "scan", since there is no UV data to attach
+pack_benchmark_scenarios = {
+    "ct21":      ("ct", "scan", "AD_HDF5", 1, 21, 1),
+    "ct21_cbf":  ("ct", "scan", "AD_CBF", 1, 21, 1),
+    "raster":    ("raster", "scan", "AD_HDF5", 1, 21*11, 11),
+    "hplc":      ("ct", "scan", "AD_HDF5", 1, 3000, 1),
+    "holder18":  ("ct", "multi", "AD_HDF5", 18, 5, 1),
+}
+
+class BenchmarkCBFHandler(PilatusCBFHandler):
+    """ reads the generated CBF files from the resource path, which is not under any of the
+        data_file_path roots
+    """
+    trigger_mode = triggerMode.software_trigger_single_frame
+
+    def __init__(self, rpath, *args, **kwargs):
+        self._bench_path = os.path.join(rpath, '')   # used by update_path(), called from __init__()
+        super().__init__(data_file_path.gpfs.value+"/", *args, **kwargs)
+
+    def update_path(self):
+        self._path = self._bench_path
+
+
+def make_benchmark_broker():
+    """ a temporary, msgpack-backed databroker, with the handlers used at the beamline
+    """
+    from databroker import temp
+    bdb = temp()
+    bdb.reg.register_handler('AD_CBF', BenchmarkCBFHandler, overwrite=True)
+    return bdb
+
+def _benchmark_frames(shape, n=4, seed=0):
+    """ a few frames that look roughly like solution scattering: low counts, decaying away from
+        the beam center, with module gaps
+    """
+    rng = np.random.default_rng(seed)
+    y,x = np.indices(shape)
+    r = np.hypot(x-shape[1]/2, y-shape[0]/3)+10
+    frames = rng.poisson(2e4/r**1.5, size=(n, *shape)).astype(np.int32)
+    frames[:, 195::212, :] = -1
+    return frames
+
+def generate_benchmark_run(bdb, data_dir, sample_name, plan_name="ct", spec="AD_HDF5",
+                           nevents=21, nres=1, dets={"pil1M": "SAXS", "pilW2": "WAXS2"}, md={}):
+    """ generate the data files and insert the documents for one run, returns the uid and the
+        number of bytes of image data
+    """
+    from event_model import compose_run
+    
+    run = compose_run(metadata={"plan_name": plan_name, "sample_name": sample_name,
+                                "scan_id": 1, "data_path": data_dir+"/", "num_points": nevents, **md})
+    bdb.insert('start', run.start_doc)
+
+    data_keys = {f"{d}_image": {"source": f"PV:{d}", "dtype": "array", "external": "FILESTORE:",
+                                "shape": list(PilatusCBFHandler.std_image_size[ext])}
+                 for d,ext in dets.items()}
+    for k in ['em1_sum_all_mean_value', 'em2_sum_all_mean_value']:
+        data_keys[k] = {"source": f"PV:{k}", "dtype": "number", "shape": []}
+    desc = run.compose_descriptor(name="primary", data_keys=data_keys)
+    bdb.insert('descriptor', desc.descriptor_doc)
+
+    nbytes = 0
+    datum_ids = {d: [] for d in dets}
+    per_res = int(np.ceil(nevents/nres))
+    for d,ext in dets.items():
+        frames = _benchmark_frames(PilatusCBFHandler.std_image_size[ext])
+        for j in range(nres):
+            n = min(per_res, nevents-j*per_res)
+            fn = f"{sample_name}_{ext}_{j:06d}"
+            if spec=="AD_HDF5":
+                with h5py.File(f"{data_dir}/{fn}.h5", "w") as f:
+                    dset = f.create_dataset("/entry/data/data", shape=(n, *frames.shape[1:]), dtype=frames.dtype,
+                                            chunks=(1, *frames.shape[1:]), compression="gzip")
+                    for i in range(n):
+                        dset[i] = frames[i%len(frames)]
+                res = run.compose_resource(spec="AD_HDF5", root="/", resource_path=f"{data_dir}/{fn}.h5"[1:],
+                                           resource_kwargs={"frame_per_point": 1})
+                datum_kwargs = [{"point_number": i} for i in range(n)]
+            else:
+                import fabio
+                for i in range(n):
+                    fabio.cbfimage.CbfImage(data=frames[i%len(frames)]).write(
+                        f"{data_dir}/{fn}_{i+1:06d}_{ext}.cbf")
+                res = run.compose_resource(spec="AD_CBF", root="/", resource_path=data_dir[1:],
+                                           resource_kwargs={"template": f"%s%s_%06d_{ext}.cbf", "filename": fn,
+                                                            "frame_per_point": 1, "initial_number": 1})
+                datum_kwargs = [{"point_number": i} for i in range(n)]
+            bdb.insert('resource', res.resource_doc)
+            for dk in datum_kwargs:
+                datum = res.compose_datum(datum_kwargs=dk)
+                bdb.insert('datum', datum)
+                datum_ids[d].append(datum['datum_id'])
+            nbytes += n*frames[0].nbytes
+
+    for i in range(nevents):
+        t = time.time()
+        data = {f"{d}_image": datum_ids[d][i] for d in dets}
+        data.update({k: np.random.random() for k in ['em1_sum_all_mean_value', 'em2_sum_all_mean_value']})
+        bdb.insert('event', desc.compose_event(data=data, timestamps={k: t for k in data.keys()}, seq_num=i+1,
+                                               filled={f"{d}_image": False for d in dets}))
+    bdb.insert('stop', run.compose_stop(exit_status='success'))
+
+    return run.start_doc['uid'],nbytes
+
+def _run_stage(func, *args, **kwargs):
+    """ run func in a forked process, so that the peak RSS can be measured for each stage
+        returns the wall time, peak RSS (bytes) and whatever func returned (must be json-able)
+        the stage needs the namespace of this session (db, pack_h5(), ...), so it is forked rather
+        than spawned; the forked process starts with the RSS of this process, which is subtracted,
+        i.e. the peak RSS is the memory added by the stage
+    """
+    rfd,wfd = os.pipe()
+    pid = os.fork()
+    if pid==0:
+        os.close(rfd)
+        # the peak RSS of the forked process so far, i.e. the RSS of the parent at fork
+        rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        try:
+            t0 = time.time()
+            ret = func(*args, **kwargs)
+            msg = {"wall": time.time()-t0, "rss0": rss0, "ret": ret}
+        except Exception as e:
+            msg = {"error": f"{type(e).__name__}: {e}"}
+        with os.fdopen(wfd, "w") as fp:
+            json.dump(msg, fp)
+        os._exit(0)
+    os.close(wfd)
+    with os.fdopen(rfd, "r") as fp:
+        msg = json.loads(fp.read() or '{"error": "stage exited without result"}')
+    _,_,ru = os.wait4(pid, 0)
+    if "error" in msg.keys():
+        raise Exception(msg["error"])
+    return msg["wall"], (ru.ru_maxrss-msg["rss0"])*1024, msg["ret"]
+
+def _benchmark_pack(stage, data_type, uids, data_dir, **kwargs):
+    if stage=="pack_h5":
+        if data_type=="multi":
+            return pack_h5(uids, data_dir, fn="packed.h5", **kwargs)
+        return pack_h5(uids[0], data_dir, **kwargs)
+    if data_type=="multi":
+        return pack_and_move(data_type, '|'.join(uids), data_dir, move_first=False)
+    return pack_and_move(data_type, uids[0], data_dir, move_first=False)
+
+def run_pack_benchmark(scenarios=None, scale=1., work_dir=None, pack_kwargs={},
+                       compare=False, save_baseline=False, baseline_file=pack_benchmark_baseline,
+                       tolerance=0.2):
+    """ generate the data for each scenario, then time pack_h5() and pack_and_move() on it
+        reports wall time, peak RSS and throughput for each stage
+        scale: fraction of the number of events in each scenario, for quick checks
+        pack_kwargs: passed to pack_h5(), e.g. {"workers": 2}
+        compare: compare the wall time and peak RSS with the baseline, report regressions larger
+            than tolerance (fraction)
+    """
+    global db
+    if scenarios is None:
+        scenarios = list(pack_benchmark_scenarios.keys())
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="pack_benchmark_")
+
+    results = {}
+    db0 = db
+    try:
+        for name in scenarios:
+            data_type = pack_benchmark_scenarios[name][1]
+            data_dir = f"{work_dir}/{name}"
+            os.makedirs(data_dir, exist_ok=True)
+            # the temporary broker must exist in this process for the packing stages to see it
+            db = make_benchmark_broker()
+            plan_name,_,spec,nruns,nevents,nres = pack_benchmark_scenarios[name]
+            nevents = max(1, int(nevents*scale))
+            md = {"holderName": name} if data_type=="multi" else {}
+            t0 = time.time()
+            uids = []
+            nbytes = 0
+            for i in range(nruns):
+                uid,nb = generate_benchmark_run(db, data_dir, f"{name}_s{i:02d}", plan_name, spec, 
+                                                nevents, min(nres, nevents), md=md)
+                uids.append(uid)
+                nbytes += nb
+            results[name] = {"generate": {"wall": time.time()-t0}, "nbytes": nbytes}
+            for stage in ["pack_h5", "pack_and_move"]:
+                wall,rss,ret = _run_stage(_benchmark_pack, stage, data_type, uids, data_dir, **pack_kwargs)
+                results[name][stage] = {"wall": wall, "rss": rss, "MBps": nbytes/1e6/wall}
+    finally:
+        db = db0
+
+    baseline = {}
+    if compare and os.path.exists(baseline_file):
+        with open(baseline_file, "r") as fp:
+            baseline = json.load(fp)
+    print(f"{'scenario':>10} {'stage':>14} {'wall (s)':>9} {'RSS (MB)':>9} {'MB/s':>8}")
+    for name,res in results.items():
+        print(f"{name:>10} {'generate':>14} {res['generate']['wall']:9.2f}")
+        for stage in ["pack_h5", "pack_and_move"]:
+            r = res[stage]
+            msg = f"{name:>10} {stage:>14} {r['wall']:9.2f} {r['rss']/1e6:9.1f} {r['MBps']:8.1f}"
+            if name in baseline.keys():
+                b = baseline[name][stage]
+                msg += f"   baseline: {b['wall']:9.2f} {b['rss']/1e6:9.1f}"
+                if r['wall']>b['wall']*(1+tolerance) or r['rss']>b['rss']*(1+tolerance):
+                    msg += "   ** regression **"
+            print(msg)
+
+    if save_baseline:
+        if os.path.exists(baseline_file):
+            with open(baseline_file, "r") as fp:
+                baseline = json.load(fp)
+        baseline.update(results)
+        with open(baseline_file, "w") as fp:
+            json.dump(baseline, fp, indent=2)
+        print(f"baseline saved to {baseline_file}")
+
+    return results
+
+
+def _file_sha1(fn):
+    with open(fn, "rb") as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+def run_pipeline_benchmark(nsamples=18, nevents=5, work_dir=None, bandwidth=100e6, streams=4):
+    """ end-to-end latency of pack_and_move() for a holder, with the data starting on the RAMDISK:
+        the files are moved before packing (move_first), or packed while being moved (pipeline)
+        the RAMDISK is a local directory, with the copies slowed down to bandwidth (bytes/sec)
+        the packed files from the two modes should be identical
+    """
+    global db,ramdisk_transfer,ramdisk_path_map,ramdisk_claims
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="pipeline_benchmark_")
+    holder = "holder18"
+    gpfs_dir = f"{work_dir}/gpfs/"
+    ramdisk_dir = f"{work_dir}/ramdisk/"
+    data_dir = f"{work_dir}/data/"
+    dest_dir = f"{work_dir}/packed"
+    os.makedirs(gpfs_dir+holder)
+    os.makedirs(data_dir)
+    os.makedirs(dest_dir)
+    
+    results = {}
+    saved = (db, ramdisk_transfer, ramdisk_path_map, ramdisk_claims)
+    try:
+        db = make_benchmark_broker()
+        ramdisk_transfer = TransferManager(LocalTransferBackend(bandwidth), streams=streams)
+        ramdisk_path_map = (gpfs_dir, ramdisk_dir)
+        ramdisk_claims = RamdiskClaims(f"{work_dir}/claims")
+        uids = []
+        nbytes = 0
+        for i in range(nsamples):
+            uid,nb = generate_benchmark_run(db, gpfs_dir+holder, f"{holder}_s{i:02d}", "ct", "AD_HDF5", nevents, 
+                                            md={"holderName": holder, "data_path": gpfs_dir})
+            uids.append(uid)
+            nbytes += nb
+        # the data files are written on GPFS, the resources point there; keep them aside, then 
+        # start each mode with a fresh copy on the RAMDISK, and nothing on GPFS
+        shutil.move(gpfs_dir+holder, data_dir+holder)
+        
+        for mode in ["move_first", "pipeline"]:
+            for d in [gpfs_dir+holder, ramdisk_dir+holder]:
+                shutil.rmtree(d, ignore_errors=True)
+            shutil.copytree(data_dir+holder, ramdisk_dir+holder)
+            wall,rss,fn = _run_stage(pack_and_move, "multi", '|'.join(uids), dest_dir, move_first=True, 
+                                     froot=data_file_path.ramdisk, pipeline=(mode=="pipeline"))
+            results[mode] = {"wall": wall, "rss": rss, "sha1": _file_sha1(fn)}
+            os.rename(fn, f"{fn}.{mode}")
+    finally:
+        db,ramdisk_transfer,ramdisk_path_map,ramdisk_claims = saved
+    
+    print(f"{nsamples} samples, {nbytes/1e6:.1f} MB, moved at {bandwidth/1e6:.0f} MB/s using {streams} streams")
+    for mode,r in results.items():
+        print(f"{mode:>12}: {r['wall']:7.2f} sec, {r['rss']/1e6:7.1f} MB peak RSS")
+    if results["move_first"]["sha1"]!=results["pipeline"]["sha1"]:
+        print("** the packed files are different **")
+    return results
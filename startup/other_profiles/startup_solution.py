@@ -62,6 +62,8 @@ def collect_std(r_range=1.5):
     dexp.detectors[0].fix_scale = 0.93
     dexp.detectors[1].fix_scale = (dexp.detectors[0].exp_para.Dd/dexp.detectors[1].exp_para.Dd)**2
     dexp.save_detectors()
+    # the packing jobs in this process should read the new calibration
+    h5exp_cache.invalidate("exp.h5")
     
 def collect_reference_from_tube12():
     nd_list = ['upstream','downstream']
@@ -324,7 +326,10 @@ def get_holders(spreadSheet, configName):
                 
 def measure_holder(spreadSheet, holderName, sheet_name='Holders', exp_time=1, repeats=5, vol=45, 
                    returnSample=True, concurrentOp=False, checkSampleSequence=False, 
-                   em2_thresh=30000, check_bm_period=900):
+                   em2_thresh=30000, check_bm_period=900, remote_packing=False, packing_jobs=None):
+    """ remote_packing: send the data to the packing server instead of packing in this process
+        packing_jobs: if a list is given, the id of the packing job is appended to it
+    """
     #print('collecting reference')
     #collect_reference()
     #pack_ref_h5(run_id)
@@ -374,7 +379,9 @@ def measure_holder(spreadSheet, holderName, sheet_name='Holders', exp_time=1, re
         
     del RE.md['holderName']
     pil.use_sub_directory()
-    HT_pack_h5(samples=samples, uids=uids)
+    job_id = HT_pack_h5(samples=samples, uids=uids, remote=remote_packing)
+    if packing_jobs is not None and job_id is not None:
+        packing_jobs.append(job_id)
         
     for nd in sol.needle_dirty_flag.keys():
         if sol.needle_dirty_flag[nd]:
@@ -413,8 +420,11 @@ def check_pause():
             
     
 def auto_measure_samples(spreadSheet, configName, exp_time=1, repeats=5, vol=45, sim_only=False,
-                        returnSample=True, concurrentOp=False, checkSampleSequence=False):
+                        returnSample=True, concurrentOp=False, checkSampleSequence=False,
+                        remote_packing=False, packing_timeout=1800):
     """ measure all sample holders defined in a given configuration in the spreadsheet
+        remote_packing: pack/process the data on the packing server; before the next holder is 
+            measured, wait (up to packing_timeout sec) for the previous holder to be processed
     """
     if data_path is None:
         raise exception("login first !")
@@ -429,6 +439,7 @@ def auto_measure_samples(spreadSheet, configName, exp_time=1, repeats=5, vol=45,
         sheet_name = 0
         holders = configName  # called from measure_mailin_spreadsheets()
 
+    packing_jobs = []
     rbt.goHome()
     for p in list(holders.keys()):
         sol.select_flow_cell('bottom')
@@ -445,10 +456,13 @@ def auto_measure_samples(spreadSheet, configName, exp_time=1, repeats=5, vol=45,
             sol.select_tube_pos(1)
             countdown("simulating data collection ", 60)
         else:
+            if len(packing_jobs)>0:
+                check_packing_job(packing_jobs[-1], timeout=packing_timeout)
             uids,samples = measure_holder(spreadSheet, holderName, sheet_name=sheet_name,
                                           exp_time=exp_time, repeats=repeats, vol=vol,
                                           returnSample=returnSample, concurrentOp=concurrentOp,
-                                          checkSampleSequence=checkSampleSequence)
+                                          checkSampleSequence=checkSampleSequence,
+                                          remote_packing=remote_packing, packing_jobs=packing_jobs)
 
         sol.select_tube_pos('park')
 
@@ -562,9 +576,10 @@ def measure_mailin_spreadsheets(sh_list, sample_locs=None, check_QR_only=False):
 
 
 def HT_pack_h5(spreadSheet=None, holderName=None, froot=data_file_path.gpfs, 
-               run_id=None, samples=None, uids=None, **kwargs):
+               run_id=None, samples=None, uids=None, remote=False, **kwargs):
     """ this is useful for packing h5 after the experiment
         it will not perform buffer subtraction
+        remote: send to the packing server, returns the job id
     """
     if samples is None:
         samples = get_samples(spreadSheet, holderName, sheet_name=0)
@@ -576,6 +591,8 @@ def HT_pack_h5(spreadSheet=None, holderName=None, froot=data_file_path.gpfs,
         if 'bufferName' in samples[s].keys():
             sb_dict[s] = [samples[s]['bufferName']]
     uids.append(json.dumps(sb_dict))
+    if remote:
+        return send_to_packing_queue_remote('|'.join(uids), "sol", froot)
     send_to_packing_queue('|'.join(uids), "sol", froot)
     
             
@@ -717,14 +734,36 @@ def collect_hplc(sample_name, exp, nframes):
     change_sample()
      
 
-def run_hplc_from_spreadsheet(spreadsheet_fn, batchID, sheet_name='Samples', exp=1, shutdown=False):
+def check_packing_job(job_id, timeout=0):
+    """ report the state of a job on the packing server, waiting up to timeout (sec) for it to finish
+        returns True if the job finished successfully
+    """
+    job = wait_for_packing(job_id, timeout=timeout) if timeout>0 else packing_job_status(job_id)
+    if job is None or job['state'] not in ["done", "failed", "cancelled"]:
+        print(f"packing job {job_id} has not finished yet ...")
+        return False
+    if job['state']!="done":
+        print(f"packing job {job_id} {job['state']}: {job['message']}")
+        return False
+    print(f"packing job {job_id} done: " + ", ".join([f"{k} {v:.0f}s" for k,v in job['timings'].items()]))
+    return True
+
+def run_hplc_from_spreadsheet(spreadsheet_fn, batchID, sheet_name='Samples', exp=1, shutdown=False,
+                              remote_packing=False):
+    """ remote_packing: send the data to the packing server, the state of the packing job for the
+            previous sample is reported before the next sample
+    """
     batch_fn,winDataPath,samples = createShimadzuBatchFile(spreadsheet_fn, batchID=batchID,
                                                            sheet_name=sheet_name, 
                                                            check_sname=True,
                                                            shutdown=shutdown)
     print("HPLC batch file has been created in %s: %s" % (winDataPath,batch_fn))
     input("please start batch data collection from the Shimadzu software, then hit enter:")
+    job_id = None
     for sn in samples.keys():
+        # the batch is running on the HPLC, no waiting here
+        if job_id is not None:
+            check_packing_job(job_id)
         RE.md['HPLC'] = samples[sn]['md']
         print(f"collecting data for {sn} ...")
         # for hardware multiple trigger, the interval between triggers is slightly longer
@@ -732,7 +771,10 @@ def run_hplc_from_spreadsheet(spreadsheet_fn, batchID, sheet_name='Samples', exp
         #    it in the caulcation of nframes
         collect_hplc(sn, exp=exp, nframes=int(samples[sn]["acq time"]*60/exp))   
         uid=db[-1].start['uid']
-        send_to_packing_queue(uid, "HPLC", froot=data_file_path.gpfs)
+        if remote_packing:
+            job_id = send_to_packing_queue_remote(uid, "HPLC", froot=data_file_path.gpfs)
+        else:
+            send_to_packing_queue(uid, "HPLC", froot=data_file_path.gpfs)
         del RE.md['HPLC']
     pil.use_sub_directory()    
     print('batch collection collected for %s from %s' % (sheet_name,spreadsheet_fn))
@@ -0,0 +1,74 @@
+""" the byte-offset decoder in startup/32-cbf.py should read the same data from Pilatus CBF files
+    as fabio, for every kind of delta: int8, int16 and int32 escapes, next to each other
+"""
+import os
+import numpy as np
+import pytest
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+startup_dir = os.path.join(test_dir, "..", "startup")
+# written using fabio.cbfimage.CbfImage(data=pilatus_frame(), header=...).write()
+stored_cbf = os.path.join(test_dir, "data", "pilatus_escapes.cbf")
+
+def load_startup(fn):
+    ns = {}
+    exec(compile(open(os.path.join(startup_dir, fn)).read(), fn, "exec"), ns)
+    return ns
+
+cbf = load_startup("32-cbf.py")
+decoders = [pytest.param(False, id="numpy"),
+            pytest.param(True, id="numba", marks=pytest.mark.skipif(cbf["numba"] is None,
+                                                                    reason="numba is not available"))]
+
+def pilatus_frame(shape=(97, 83)):
+    """ counts, with -1 in the module gaps and -2 for a bad pixel, and a row of deltas at the
+        boundaries of the int8/int16/int32 encodings, including the Pilatus overflow value
+    """
+    i,j = np.indices(shape)
+    data = ((i*7+j*13)%50).astype(np.int32)
+    data[:, 40:43] = -1
+    data[60:65, :] = -1
+    data[10, 5] = -2
+    seq = [127, 0, 128, 0, -127, 0, -128, 0, -129, 0, 300, -300, 32767, 0, 32768, 0, -32767, 0,
+           -32768, 0, -32769, 0, 1048575, -1, 1048575, 0, -2**30, 2**30-1, 0, 5, 2**30, -5,
+           2**30-1, -2**30+1, 40000, -40000]
+    data[20, :len(seq)] = seq
+    data[30, :] = np.arange(shape[1])*1000 - 20000
+    data[-1, -1] = 1048575
+    return data
+
+@pytest.mark.parametrize("use_numba", decoders)
+def test_stored_cbf(use_numba):
+    data = cbf["cbf_read"](stored_cbf, use_numba=use_numba)
+    assert data.dtype==np.int32
+    np.testing.assert_array_equal(data, pilatus_frame())
+
+@pytest.mark.parametrize("use_numba", decoders)
+def test_stored_cbf_matches_fabio(use_numba):
+    fabio = pytest.importorskip("fabio")
+    ref = fabio.open(stored_cbf).data
+    out = np.empty(ref.shape, dtype=np.int32)
+    np.testing.assert_array_equal(cbf["cbf_read"](stored_cbf, out, use_numba=use_numba), ref)
+
+@pytest.mark.parametrize("use_numba", decoders)
+def test_random_frames_match_fabio(tmp_path, use_numba):
+    """ the escapes are at random positions, often within a few bytes of each other
+    """
+    fabio = pytest.importorskip("fabio")
+    import fabio.cbfimage
+    rng = np.random.default_rng(0)
+    for k in range(5):
+        data = rng.poisson(5, size=(103, 98)).astype(np.int32)
+        for scale in [200, 40000, 2**24]:
+            idx = rng.integers(0, data.size, size=300)
+            data.flat[idx] = rng.integers(-scale, scale, size=len(idx))
+        data[:, 50:52] = -1
+        fn = str(tmp_path/f"frame{k}.cbf")
+        fabio.cbfimage.CbfImage(data=data).write(fn)
+        ref = fabio.open(fn).data
+        np.testing.assert_array_equal(ref, data)
+        np.testing.assert_array_equal(cbf["cbf_read"](fn, use_numba=use_numba), ref)
+
+def test_verify_cbf_decoder():
+    pytest.importorskip("fabio")
+    assert cbf["verify_cbf_decoder"]([stored_cbf])==[]
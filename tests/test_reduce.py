@@ -0,0 +1,96 @@
+""" H5Reducer (startup/34-reduce.py) should write the same 1D data as h5xs.load_data()
+"""
+import os,shutil
+# h5xs.load_data() forks worker processes, which keep the file locked
+os.environ["HDF5_USE_FILE_LOCKING"] = "FALSE"
+import numpy as np
+import h5py
+import pytest
+
+pytest.importorskip("py4xs")
+from py4xs.exp_para import ExpParaLiX
+from py4xs.detector_config import DetectorConfig
+from py4xs.hdf import h5xs
+
+startup_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "startup")
+
+def load_startup(fn):
+    ns = {}
+    exec(compile(open(os.path.join(startup_dir, fn)).read(), fn, "exec"), ns)
+    return ns
+
+def make_det(ext, width, height, bm_ctr_x, bm_ctr_y):
+    ep = ExpParaLiX(width, height)
+    ep.wavelength = 0.885
+    ep.bm_ctr_x,ep.bm_ctr_y = bm_ctr_x,bm_ctr_y
+    ep.ratioDw = 30.
+    ep.grazing_incident = False
+    ep.flip = 0
+    ep.incident_angle = 0.2
+    ep.sample_normal = 0
+    ep.fix_azimuthal_angles = False
+    return DetectorConfig(ext, exp_para=ep, fix_scale=1)
+
+@pytest.fixture
+def packed(tmp_path):
+    """ a packed file with 2 detectors, 4 frames, and the detector configuration
+    """
+    rng = np.random.default_rng(0)
+    dets = [make_det("_SAXS", 60, 50, 30, -5), make_det("_WAXS2", 40, 30, -60, 15)]
+    qgrid = np.linspace(0.02, 0.6, 50)
+    images = {"_SAXS": rng.poisson(100, (4, 50, 60)).astype(np.int32), 
+              "_WAXS2": rng.poisson(50, (4, 30, 40)).astype(np.int32)}
+    fn = str(tmp_path/"packed.h5")
+    with h5py.File(fn, "w") as f:
+        grp = f.create_group("s1/primary/data")
+        grp["pil1M_image"] = images["_SAXS"]
+        grp["pilW2_image"] = images["_WAXS2"]
+    return fn,dets,qgrid,images
+
+def processed(fn, sn="s1"):
+    with h5py.File(fn, "r") as f:
+        return {k: f[f"{sn}/processed/{k}"][...] for k in f[f"{sn}/processed"].keys()}
+
+@pytest.mark.parametrize("keys", [{"_SAXS": "pil1M_image", "_WAXS2": "pilW2_image"},
+                                  {"_SAXS": "pil1M_ext_image", "_WAXS2": "pilW2_ext_image"}])
+def test_reducer_matches_load_data(packed, keys):
+    fn,dets,qgrid,images = packed
+    fn_ref = fn.replace(".h5", "_ref.h5")
+    shutil.copy(fn, fn_ref)
+    
+    dt = h5xs(fn_ref, [dets, qgrid], transField='')
+    dt.load_data(N=1)
+    dt.fh5.close()
+    
+    ns = load_startup("34-reduce.py")
+    reducer = ns['H5Reducer'](dets, qgrid)
+    for ext,key in keys.items():
+        assert key in reducer.keys
+        for img in images[ext]:
+            reducer.frame(key, img)
+    with h5py.File(fn, "r+") as f:
+        reducer.end(f["s1"])
+    
+    ref = processed(fn_ref)
+    ret = processed(fn)
+    assert sorted(ret.keys())==sorted(ref.keys())==["_SAXS", "_WAXS2", "merged"]
+    for k in ref.keys():
+        assert ret[k].shape==ref[k].shape==(4, 2, len(qgrid))
+        np.testing.assert_allclose(ret[k], ref[k], equal_nan=True)
+
+def test_reducer_loaded_by_h5xs(packed):
+    """ the reduced data can be read using h5xs.load_d1s()
+    """
+    fn,dets,qgrid,images = packed
+    ns = load_startup("34-reduce.py")
+    reducer = ns['H5Reducer'](dets, qgrid)
+    for img in images["_SAXS"]:
+        reducer.frame("pil1M_image", img)
+    for img in images["_WAXS2"]:
+        reducer.frame("pilW2_image", img)
+    with h5py.File(fn, "r+") as f:
+        reducer.end(f["s1"])
+    dt = h5xs(fn, [dets, qgrid], transField='')
+    dt.load_d1s("s1")
+    assert len(dt.d1s["s1"]["merged"])==4
+    np.testing.assert_allclose(dt.d1s["s1"]["merged"][0].qgrid, qgrid)